@@ -0,0 +1,81 @@
+import numpy as np
+
+from instrumentation import stage
+
+# Size of the grid cells current positions are binned into, in degrees
+CELL_DEGREES = 0.02
+
+
+def count_locations(ids, num_locations):
+    """
+    Function to count the rows of each location id with a single bincount.
+    Returns the ids of the occupied locations and their counts; unknown ids (-1) are ignored.
+    """
+    with stage('aggregate', rows=len(ids)):
+        ids = np.asarray(ids)
+        counts = np.bincount(ids[ids >= 0], minlength=num_locations)
+        occupied = np.flatnonzero(counts)
+        return occupied, counts[occupied]
+
+
+def count_cells(lon, lat, cell_degrees=CELL_DEGREES):
+    """
+    Function to bin positions into a regular longitude/latitude grid.
+    Returns the mean longitude, mean latitude and count of every occupied cell, so agents sharing
+    a location keep its exact coordinates and agents on a link are merged with their neighbours.
+    """
+    with stage('aggregate', rows=len(lon)):
+        return _count_cells(lon, lat, cell_degrees)
+
+
+def _count_cells(lon, lat, cell_degrees):
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    valid = np.isfinite(lon) & np.isfinite(lat)
+    lon, lat = lon[valid], lat[valid]
+    if len(lon) == 0:
+        return np.empty(0), np.empty(0), np.empty(0, dtype=np.int64)
+
+    # Flatten the (column, row) of each position into one cell number within the occupied span
+    col = np.floor(lon / cell_degrees).astype(np.int64)
+    row = np.floor(lat / cell_degrees).astype(np.int64)
+    col -= col.min()
+    row -= row.min()
+    cells = row * (col.max() + 1) + col
+
+    counts = np.bincount(cells)
+    occupied = np.flatnonzero(counts)
+    counts = counts[occupied]
+    mean_lon = np.bincount(cells, weights=lon)[occupied] / counts
+    mean_lat = np.bincount(cells, weights=lat)[occupied] / counts
+    return mean_lon, mean_lat, counts
+
+
+def sum_edges(start_ids, end_ids, values, num_locations):
+    """
+    Function to combine the rows of each (start, end) edge, e.g. the partial counts of the same link in all rank files.
+    Each edge gets one integer id, and the values are summed with a single bincount over the distinct ids.
+    Returns the start ids, end ids and summed values of the distinct edges; rows with unknown ids (-1) are dropped.
+    """
+    with stage('aggregate', rows=len(start_ids)):
+        start_ids = np.asarray(start_ids, dtype=np.int64)
+        end_ids = np.asarray(end_ids, dtype=np.int64)
+        values = np.asarray(values, dtype=float)
+        valid = (start_ids >= 0) & (end_ids >= 0)
+
+        edge_ids = start_ids[valid] * num_locations + end_ids[valid]
+        edges, inverse = np.unique(edge_ids, return_inverse=True)
+        sums = np.bincount(inverse, weights=values[valid], minlength=len(edges))
+        return edges // num_locations, edges % num_locations, sums
+
+
+def marker_sizes(counts, min_size=50, max_size=500, scale=None):
+    """
+    Function to turn population counts into marker areas, clipped to a readable range.
+    With a `scale`, areas are proportional to the counts and a count of `scale` gets the largest marker,
+    so the range adapts to the populations of the run instead of saturating at `max_size` agents.
+    """
+    counts = np.asarray(counts, dtype=float)
+    if scale:
+        counts = counts * (max_size / scale)
+    return np.clip(counts, min_size, max_size)
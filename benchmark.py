@@ -0,0 +1,311 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import traceback
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import matplotlib
+
+matplotlib.use('Agg')
+
+from renderer import MapRenderer, get_renderer
+from encoder import FFmpegWriter, encode_pngs
+from locations import LocationIndex, set_location_index
+from readers import iter_agents_batches, DEFAULT_MEMORY_BUDGET
+from partition import PartitionWriter, write_partitions, list_timesteps, load_timestep
+from aggregate import count_locations, count_cells
+from instrumentation import get_recorder, stage
+
+import video_agents
+import video_links
+
+# Version of the report layout
+REPORT_VERSION = 2
+
+# Header of the agents.out.* files written by Flee
+AGENTS_HEADER = [
+    '#time', 'rank-agentid', 'agent location type', 'current_location', 'gps_x', 'gps_y', 'is_travelling',
+    'distance_travelled', 'places_travelled', 'distance_moved_this_timestep', 'original_location'
+]
+
+
+def generate_output(output_dir, ranks=4, agents=10000, timesteps=10, locations=100, links=50, seed=0):
+    """
+    Function to write a synthetic Flee output directory: input_csv/locations.csv and one
+    agents.out.* and links.out.* file per rank. `agents` is the number of agents per rank and
+    `links` the number of links reported per rank and timestep.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(output_dir, 'input_csv'), exist_ok=True)
+
+    # Locations spread over the default map extent
+    names = np.array([f"Location_{i}" for i in range(locations)])
+    latitude = rng.uniform(5, 13, locations)
+    longitude = rng.uniform(3, 14, locations)
+    pd.DataFrame({
+        '#name': names,
+        'region': 'Region',
+        'country': 'Nigeria',
+        'latitude': latitude.round(4),
+        'longitude': longitude.round(4),
+        'location_type': 'town',
+        'conflict_date': '',
+        'pop/cap': 1000,
+    }).to_csv(os.path.join(output_dir, 'input_csv', 'locations.csv'), index=False)
+
+    for rank in range(ranks):
+        original = rng.integers(0, locations, agents)
+        agent_ids = np.array([f"{rank}-{agent}" for agent in range(agents)])
+
+        with open(os.path.join(output_dir, f'agents.out.{rank}'), 'w') as f:
+            f.write(','.join(AGENTS_HEADER) + '\n')
+            for timestep in range(timesteps):
+                current = rng.integers(0, locations, agents)
+
+                # About a third of the agents are travelling on a link
+                travelling = rng.random(agents) < 0.3
+                current_location = np.where(
+                    travelling, 'L:' + names[original] + ':' + names[current], names[current]
+                )
+                pd.DataFrame({
+                    '#time': timestep,
+                    'rank-agentid': agent_ids,
+                    'agent location type': 'town',
+                    'current_location': current_location,
+                    'gps_x': (latitude[current] + rng.normal(0, 0.05, agents)).round(4),
+                    'gps_y': (longitude[current] + rng.normal(0, 0.05, agents)).round(4),
+                    'is_travelling': travelling,
+                    'distance_travelled': rng.integers(0, 500, agents),
+                    'places_travelled': rng.integers(1, 5, agents),
+                    'distance_moved_this_timestep': rng.integers(0, 50, agents),
+                    'original_location': names[original],
+                }).to_csv(f, header=False, index=False)
+
+        with open(os.path.join(output_dir, f'links.out.{rank}'), 'w') as f:
+            f.write('#time,start_location,end_location,cum_num_agents\n')
+            for timestep in range(timesteps):
+                pd.DataFrame({
+                    '#time': timestep,
+                    'start_location': names[rng.integers(0, locations, links)],
+                    'end_location': names[rng.integers(0, locations, links)],
+                    'cum_num_agents': rng.integers(0, 1500, links),
+                }).to_csv(f, header=False, index=False)
+
+
+def take_stages(stages, name_format='{}'):
+    """
+    Function to move the stages recorded by this process since the last call into the benchmark stages,
+    renamed with `name_format` (e.g. 'links_{}'), so that the same pipeline stage of different phases is
+    reported separately. Stages recorded by the pipeline never overlap, so their seconds add up to the total.
+    """
+    recorder = get_recorder()
+    for name, entry in recorder.snapshot()['stages'].items():
+        total = stages.setdefault(
+            name_format.format(name), {'seconds': 0.0, 'calls': 0, 'rows': 0, 'bytes': 0, 'peak_rss': 0}
+        )
+        for key in ('seconds', 'calls', 'rows', 'bytes'):
+            total[key] += entry[key]
+        total['peak_rss'] = max(total['peak_rss'], entry['peak_rss'])
+    recorder.stages.clear()
+
+
+def git_revision():
+    """
+    Function to return the commit of the code being benchmarked, if it is a git checkout.
+    """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(output_dir, max_frames=None, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """
+    Function to run every stage of the agents and links pipelines on a Flee output directory
+    in this process. Stages are timed by the instrumentation of the pipeline itself and reported per phase.
+    """
+    stages = {}
+    partition_dir = os.path.join(output_dir, 'benchmark_partitions')
+    png_dir = os.path.join(output_dir, 'benchmark_pngs')
+    shutil.rmtree(partition_dir, ignore_errors=True)
+    shutil.rmtree(png_dir, ignore_errors=True)
+    os.makedirs(png_dir)
+
+    # Stages recorded before the benchmark, e.g. while generating the output, are left out
+    take_stages({})
+
+    locations_file = os.path.join(output_dir, 'input_csv', 'locations.csv')
+    with stage('locations', nbytes=os.path.getsize(locations_file)):
+        index = LocationIndex.from_csv(locations_file)
+    set_location_index(index)
+    take_stages(stages)
+
+    # Agents: read, join and partition each file
+    agents_dir = os.path.join(partition_dir, 'agents')
+    agents_files = sorted(glob.glob(os.path.join(output_dir, 'agents.out.*')), key=lambda x: int(x.split('.')[-1]))
+    for file in agents_files:
+        writer = PartitionWriter(file, agents_dir)
+        for timestep, df in iter_agents_batches(file, memory_budget):
+            df['original_id'] = index.lookup(df['original_location'])
+            df = df.drop(columns=['original_location', 'current_location'])
+            writer.write(timestep, df)
+    take_stages(stages)
+
+    # Links: read, join and partition each file
+    links_dir = os.path.join(partition_dir, 'links')
+    links_files = sorted(glob.glob(os.path.join(output_dir, 'links.out.*')), key=lambda x: int(x.split('.')[-1]))
+    for file in links_files:
+        df = video_links.process_file(file)
+        df['start_id'] = index.lookup(df['start_location'])
+        df['end_id'] = index.lookup(df['end_location'])
+        df = df[['#time', 'start_id', 'end_id', 'cum_num_agents']]
+        write_partitions(df, file, links_dir)
+    take_stages(stages, 'links_{}')
+
+    # Building the map projection and background is a one-off cost per worker
+    get_renderer('agents', legend=video_agents.LEGEND)
+    get_renderer('links')
+    take_stages(stages, 'renderer_{}')
+
+    timesteps = list_timesteps(agents_dir)[:max_frames]
+    agents_frames = []
+    for timestep in timesteps:
+        agents_data = load_timestep(agents_dir, timestep)
+        links_data = load_timestep(links_dir, timestep)
+
+        # Aggregation is timed on its own here, and again as part of rendering the agents layer
+        count_locations(agents_data['original_id'].values, len(index))
+        count_cells(agents_data['gps_y'].values, agents_data['gps_x'].values)
+        take_stages(stages)
+
+        frame = video_agents.render_timestep(timestep, agents_data)
+        agents_frames.append(frame)
+        take_stages(stages, '{}_agents')
+        if links_data is not None:
+            video_links.render_timestep(timestep, links_data)
+            take_stages(stages, '{}_links')
+
+        MapRenderer.save(frame, os.path.join(png_dir, f"agents_timestep_{timestep:03d}.png"))
+        take_stages(stages)
+
+    # Encoding from PNG files, as make_video_agents.py does, and from frames in memory, as video_agents.py does
+    png_files = sorted(glob.glob(os.path.join(png_dir, 'agents_timestep_*.png')))
+    encode_pngs(png_files, os.path.join(png_dir, 'agents_from_pngs.mp4'))
+    take_stages(stages, '{}_pngs')
+    with FFmpegWriter(os.path.join(png_dir, 'agents_from_frames.mp4')) as writer:
+        for frame in agents_frames:
+            writer.write(frame)
+    take_stages(stages, '{}_frames')
+
+    shutil.rmtree(partition_dir, ignore_errors=True)
+    shutil.rmtree(png_dir, ignore_errors=True)
+    return stages
+
+
+def print_report(stages):
+    """
+    Function to print the stage timings as a table.
+    """
+    total = sum(entry['seconds'] for entry in stages.values())
+    print(f"{'stage':<16} {'calls':>6} {'seconds':>9} {'share':>7} {'rows':>12} {'MB':>9}")
+    for name, entry in stages.items():
+        share = 100 * entry['seconds'] / total if total else 0
+        print(
+            f"{name:<16} {entry['calls']:>6} {entry['seconds']:>9.3f} {share:>6.1f}% "
+            f"{entry['rows']:>12} {entry['bytes'] / 1024 ** 2:>9.2f}"
+        )
+    print(f"{'total':<16} {'':>6} {total:>9.3f}")
+
+
+def print_comparison(stages, baseline_file):
+    """
+    Function to print the speedup of each stage relative to an earlier report.
+    """
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    print(f"Comparison with {baseline_file} (revision {baseline.get('revision')}):")
+    print(f"{'stage':<16} {'before':>9} {'after':>9} {'speedup':>8}")
+    for name, entry in stages.items():
+        before = baseline.get('stages', {}).get(name, {}).get('seconds')
+        if before is None:
+            print(f"{name:<16} {'-':>9} {entry['seconds']:>9.3f} {'-':>8}")
+        else:
+            speedup = before / entry['seconds'] if entry['seconds'] else float('inf')
+            print(f"{name:<16} {before:>9.3f} {entry['seconds']:>9.3f} {speedup:>7.2f}x")
+
+
+if __name__ == "__main__":
+    """
+    Main function to generate a synthetic Flee output and benchmark every stage on it.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the processing stages on synthetic Flee output.")
+    parser.add_argument("--ranks", type=int, default=4, help="Number of rank files to generate.")
+    parser.add_argument("--agents", type=int, default=10000, help="Number of agents per rank file.")
+    parser.add_argument("--timesteps", type=int, default=10, help="Number of timesteps.")
+    parser.add_argument("--locations", type=int, default=100, help="Number of locations.")
+    parser.add_argument("--links", type=int, default=50, help="Number of links per rank file and timestep.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data.")
+    parser.add_argument("--max-frames", type=int, default=None, help="Render at most this many timesteps.")
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        default=None,
+        help="Benchmark an existing Flee output directory instead of generating one."
+    )
+    parser.add_argument("--report", type=str, default="benchmark_report.json", help="Path of the JSON report.")
+    parser.add_argument("--compare", type=str, default=None, help="Print speedups relative to an earlier JSON report.")
+    args = parser.parse_args()
+
+    config = {key: value for key, value in vars(args).items() if key not in ('report', 'compare')}
+    work_dir = None
+    try:
+        output_dir = args.output_dir
+        generate_seconds = None
+        if output_dir is None:
+            work_dir = tempfile.mkdtemp(prefix='flee_benchmark_')
+            output_dir = work_dir
+            print(f"Generating synthetic output in {output_dir}", flush=True)
+            start = time.perf_counter()
+            generate_output(output_dir, args.ranks, args.agents, args.timesteps, args.locations, args.links, args.seed)
+            generate_seconds = time.perf_counter() - start
+
+        stages = run_benchmark(output_dir, args.max_frames)
+        print_report(stages)
+
+        report = {
+            'version': REPORT_VERSION,
+            'created': datetime.now(timezone.utc).isoformat(),
+            'revision': git_revision(),
+            'config': config,
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'numpy': np.__version__,
+                'pandas': pd.__version__,
+                'matplotlib': matplotlib.__version__,
+            },
+            'generate_seconds': generate_seconds,
+            'stages': stages,
+        }
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.report}")
+        if args.compare:
+            print_comparison(stages, args.compare)
+    except Exception as e:
+        print(f"Error in benchmark: {traceback.format_exc()}")
+    finally:
+        if work_dir is not None:
+            shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,135 @@
+import json
+import os
+
+from PIL import Image
+
+# Version of the journal layout
+JOURNAL_VERSION = 1
+
+
+def verify_png(path):
+    """
+    Function to check that a PNG file exists and decodes completely.
+    Truncated or corrupted files, e.g. from a job killed while writing, fail the check.
+    """
+    try:
+        with Image.open(path) as image:
+            image.verify()
+        # verify() only checks the chunk structure; decoding the pixels catches truncated image data
+        with Image.open(path) as image:
+            image.load()
+        return True
+    except (OSError, SyntaxError, ValueError):
+        return False
+
+
+class Journal:
+    """
+    Journal of the completed work units of a job, so that a resubmitted job only runs the missing ones.
+    Every completed unit is appended as one JSON line and synced to disk, so a job killed at any point
+    leaves at most one incomplete last line, which is ignored. The journal only applies to the same
+    parameters, e.g. the same input files; units must be JSON values such as timesteps.
+    """
+
+    def __init__(self, path, params):
+        self.path = path
+        # Parameters are compared with those read back from JSON, so tuples become lists
+        self.params = json.loads(json.dumps(params))
+        self._file = None
+
+    def completed(self):
+        """
+        Return the units recorded by earlier runs with the same parameters.
+        """
+        try:
+            with open(self.path) as f:
+                lines = f.read().split('\n')
+        except OSError:
+            return set()
+
+        try:
+            header = json.loads(lines[0])
+        except ValueError:
+            return set()
+        if header != {'version': JOURNAL_VERSION, 'params': self.params}:
+            return set()
+
+        units = set()
+        for line in lines[1:]:
+            try:
+                units.add(json.loads(line)['unit'])
+            except (ValueError, KeyError, TypeError):
+                continue
+        return units
+
+    def start(self, units=()):
+        """
+        Start the journal of this run with the units already completed, replacing the previous journal atomically.
+        """
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f"{self.path}.tmp.{os.getpid()}"
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps({'version': JOURNAL_VERSION, 'params': self.params}) + '\n')
+            for unit in sorted(units):
+                f.write(json.dumps({'unit': unit}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, 'a')
+
+    def record(self, unit):
+        """
+        Record a completed unit.
+        """
+        self._file.write(json.dumps({'unit': unit}) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def remove_temporary_files(paths):
+    """
+    Function to delete the temporary files (`.<name>.tmp.<pid>`) that a killed job left while saving
+    the given output files. Other files in their directories are never touched. Returns their number.
+    """
+    outputs = {}
+    for path in paths:
+        directory, name = os.path.split(path)
+        outputs.setdefault(directory or '.', set()).add(name)
+
+    removed = 0
+    for directory, names in outputs.items():
+        try:
+            entries = os.listdir(directory)
+        except OSError:
+            continue
+        for entry in entries:
+            # Each directory is listed once, instead of one glob per output file
+            if not entry.startswith('.') or '.tmp.' not in entry or entry[1:].rsplit('.tmp.', 1)[0] not in names:
+                continue
+            try:
+                os.remove(os.path.join(directory, entry))
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+
+def resume_units(journal, units, output_path):
+    """
+    Function to find the units of a job that still have to run. With `output_path(unit)` giving the
+    file a unit writes, recorded units are skipped only if their file is still complete.
+    Temporary files the interrupted job left while saving these files are deleted first.
+    Starts the journal with the skipped units and returns the pending units, in their original order.
+    """
+    removed = remove_temporary_files(output_path(unit) for unit in units)
+    if removed:
+        print(f"Removed {removed} temporary files of an interrupted run", flush=True)
+    completed = journal.completed()
+    done = {unit for unit in units if unit in completed and verify_png(output_path(unit))}
+    journal.start(done)
+    return [unit for unit in units if unit not in done]
@@ -0,0 +1,238 @@
+import os
+import shutil
+import subprocess
+
+import numpy as np
+from PIL import Image
+
+from instrumentation import stage
+
+
+def ffmpeg_executable():
+    """
+    Function to locate the ffmpeg binary, preferring the one bundled with imageio-ffmpeg.
+    """
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except (ImportError, RuntimeError):
+        return shutil.which('ffmpeg') or 'ffmpeg'
+
+
+def fit_frame(frame, size):
+    """
+    Function to resize an RGBA frame to fit into `size` (width, height), keeping its aspect ratio,
+    and center it on a white frame of exactly that size.
+    """
+    width, height = size
+    frame_height, frame_width = frame.shape[:2]
+    if (frame_width, frame_height) == (width, height):
+        return frame
+    scale = min(width / frame_width, height / frame_height)
+    fitted_size = (max(1, round(frame_width * scale)), max(1, round(frame_height * scale)))
+
+    with stage('resize', rows=1):
+        image = Image.fromarray(np.ascontiguousarray(frame, dtype=np.uint8), 'RGBA').resize(fitted_size, Image.LANCZOS)
+        if fitted_size == (width, height):
+            return np.asarray(image)
+        canvas = Image.new('RGBA', (width, height), (255, 255, 255, 255))
+        canvas.paste(image, ((width - fitted_size[0]) // 2, (height - fitted_size[1]) // 2))
+        return np.asarray(canvas)
+
+
+class FFmpegWriter:
+    """
+    Video writer that pipes raw RGBA frames straight to an ffmpeg process, without writing images to disk.
+    The frame size is taken from the first frame written, unless `size` (width, height) is given,
+    in which case every frame is fitted into that size first (see fit_frame). With `gop`, a keyframe
+    starts every `gop` frames, e.g. so that segments of the video can be joined without re-encoding.
+    `threads` limits the encoder threads of ffmpeg (default: ffmpeg chooses).
+    """
+
+    def __init__(self, video_path, fps=2, codec='libx264', crf=None, size=None, gop=None, threads=None):
+        self.video_path = video_path
+        self.fps = fps
+        self.codec = codec
+        self.crf = crf
+        self.output_size = tuple(size) if size else None
+        self.gop = gop
+        self.threads = threads
+        self.size = None
+        self.frames_written = 0
+        self._process = None
+
+    def _start(self, width, height):
+        command = [
+            ffmpeg_executable(), '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'rgba', '-s', f"{width}x{height}", '-r', str(self.fps), '-i', '-',
+            '-an', '-c:v', self.codec, '-pix_fmt', 'yuv420p'
+        ]
+        if self.crf is not None:
+            command += ['-crf', str(self.crf)]
+        if self.gop is not None:
+            command += ['-g', str(self.gop), '-keyint_min', str(self.gop), '-sc_threshold', '0']
+        if self.threads is not None:
+            command += ['-threads', str(self.threads)]
+        command += [
+            # yuv420p needs even dimensions
+            '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+            self.video_path
+        ]
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        self.size = (width, height)
+
+    def write(self, frame):
+        """
+        Append an RGBA frame of shape (height, width, 4) to the video.
+        """
+        if self.output_size is not None:
+            frame = fit_frame(frame, self.output_size)
+        height, width = frame.shape[:2]
+        if self._process is None:
+            self._start(width, height)
+        elif (width, height) != self.size:
+            raise ValueError(f"Frame size {width}x{height} does not match the video size {self.size[0]}x{self.size[1]}")
+
+        # The pipe reads the frame buffer directly, so frames in shared memory are not copied
+        data = np.ascontiguousarray(frame, dtype=np.uint8)
+        with stage('encode', rows=1, nbytes=data.nbytes):
+            self._process.stdin.write(memoryview(data).cast('B'))
+        self.frames_written += 1
+
+    def close(self):
+        """
+        Finish the video and wait for ffmpeg to exit.
+        """
+        if self._process is None:
+            return
+        with stage('encode'):
+            self._process.stdin.close()
+            returncode = self._process.wait()
+        self._process = None
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg exited with code {returncode} while writing {self.video_path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+class OutputProfile:
+    """
+    One video produced by a rendering run: its frame size, frame rate, codec and quality (CRF).
+    Profiles without a size keep the size the frames were rendered at. Named profiles write
+    `<video>_<name>.mp4` next to the video of the run, the unnamed profile writes the video itself.
+    """
+
+    def __init__(self, name=None, size=None, fps=2, codec='libx264', crf=None):
+        self.name = name
+        self.size = tuple(size) if size else None
+        self.fps = fps
+        self.codec = codec
+        self.crf = crf
+
+    @classmethod
+    def parse(cls, spec, fps=2):
+        """
+        Build a profile from a NAME:WIDTHxHEIGHT[:fps=N][:codec=CODEC][:crf=N] specification,
+        e.g. 'preview:640x360:crf=30'. A size of 'native' keeps the rendered size.
+        """
+        parts = spec.split(':')
+        if len(parts) < 2 or not parts[0]:
+            raise ValueError(f"Output profile '{spec}' must be given as NAME:WIDTHxHEIGHT[:fps=N][:codec=CODEC][:crf=N]")
+        size = None
+        if parts[1] != 'native':
+            try:
+                size = tuple(int(v) for v in parts[1].lower().split('x'))
+            except ValueError:
+                size = ()
+            if len(size) != 2 or min(size) <= 0:
+                raise ValueError(f"Invalid size '{parts[1]}' in output profile '{spec}'")
+
+        options = {'fps': fps, 'codec': 'libx264', 'crf': None}
+        for option in parts[2:]:
+            key, _, value = option.partition('=')
+            if key not in options or not value:
+                raise ValueError(f"Invalid option '{option}' in output profile '{spec}'")
+            options[key] = value if key == 'codec' else int(value)
+        return cls(parts[0], size, **options)
+
+    def video_path(self, base_path):
+        """
+        Return the path of the video of this profile for the video path `base_path` of a run.
+        """
+        if self.name is None:
+            return base_path
+        root, ext = os.path.splitext(base_path)
+        return f"{root}_{self.name}{ext or '.mp4'}"
+
+    def writer(self, base_path, video_path=None, gop=None, threads=None):
+        """
+        Return a video writer for this profile, writing to `video_path` instead if given, e.g. a segment of the video.
+        """
+        return FFmpegWriter(
+            video_path or self.video_path(base_path), fps=self.fps, codec=self.codec, crf=self.crf, size=self.size,
+            gop=gop, threads=threads
+        )
+
+
+class MultiWriter:
+    """
+    Video writer that passes every frame to several writers, e.g. one per output profile,
+    so that all videos are encoded from the same rendered frames in a single run.
+    """
+
+    def __init__(self, writers):
+        self.writers = list(writers)
+
+    def write(self, frame):
+        for writer in self.writers:
+            writer.write(frame)
+
+    def close(self):
+        """
+        Close all writers, raising the first error after every writer was closed.
+        """
+        error = None
+        for writer in self.writers:
+            try:
+                writer.close()
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def open_profiles(profiles, base_path, threads=None):
+    """
+    Function to open one writer per output profile for the video path `base_path` of a run,
+    each with at most `threads` encoder threads if given. Returns the writer and the paths of the videos.
+    """
+    writers = [profile.writer(base_path, threads=threads) for profile in profiles]
+    return MultiWriter(writers), [writer.video_path for writer in writers]
+
+
+def read_png(png_file):
+    """
+    Function to decode a PNG file into an RGBA frame.
+    """
+    with Image.open(png_file) as image:
+        return np.asarray(image.convert('RGBA'))
+
+
+def encode_pngs(png_files, video_path, fps=2, codec='libx264', gop=None):
+    """
+    Function to encode a sorted list of PNG files into a video.
+    """
+    with FFmpegWriter(video_path, fps=fps, codec=codec, gop=gop) as writer:
+        for png_file in png_files:
+            writer.write(read_png(png_file))
+    return writer.frames_written
@@ -0,0 +1,140 @@
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import stage, add
+
+# Version of the render manifest layout
+MANIFEST_VERSION = 2
+
+
+def content_digest(*frames):
+    """
+    Function to compute a content hash of the input rows of a timestep.
+    The hash does not depend on the order of the rows, so partitions split into
+    different part files or byte ranges still hash the same. Missing inputs (None) are allowed.
+    """
+    digest = hashlib.sha1()
+    for df in frames:
+        if df is None:
+            digest.update(b'none;')
+            continue
+        df = df[sorted(df.columns)]
+        row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+        summary = [
+            len(row_hashes),
+            int(np.sum(row_hashes, dtype=np.uint64)),
+            int(np.bitwise_xor.reduce(row_hashes)) if len(row_hashes) else 0,
+        ]
+        digest.update(json.dumps([list(df.columns), [str(t) for t in df.dtypes], summary]).encode())
+    return digest.hexdigest()
+
+
+class FrameStore:
+    """
+    Store of rendered frames with a build manifest recording, per timestep, the content hash of its
+    input rows. Frames are reused as long as the hash and the render parameters are unchanged.
+    Frames are stored as raw .npy arrays and memory-mapped when reused, so nothing is encoded or decoded.
+    Frame files are named by a hash of both, so a frame is never overwritten by one rendered from other
+    inputs or parameters, and frames of an interrupted run cannot be mistaken for those of another.
+    The manifest only tracks the frames of the last complete run, to report reuse and prune old frames.
+    """
+
+    def __init__(self, frame_dir, prefix, params=None):
+        self.frame_dir = frame_dir
+        self.prefix = prefix
+        self.params = params or {}
+        self.params_digest = hashlib.sha1(json.dumps(self.params, sort_keys=True).encode()).hexdigest()
+        self.manifest_path = os.path.join(frame_dir, 'render_manifest.json')
+        self.previous = {}
+        self.current = {}
+
+        # Frames of an earlier run are only valid if they were rendered with the same parameters
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == MANIFEST_VERSION and manifest.get('params') == self.params:
+                self.previous = {int(timestep): digest for timestep, digest in manifest['frames'].items()}
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def frame_path(self, timestep, digest):
+        """
+        Return the path of the frame of a timestep rendered from inputs with hash `digest` and the parameters of the store.
+        """
+        key = hashlib.sha1(f"{self.params_digest}:{digest}".encode()).hexdigest()[:16]
+        return os.path.join(self.frame_dir, f"{self.prefix}_timestep_{int(timestep):05d}.{key}.npy")
+
+    def load(self, timestep, digest):
+        """
+        Return the stored frame of a timestep if one was rendered from the same inputs and parameters, None otherwise.
+        """
+        try:
+            return np.load(self.frame_path(timestep, digest), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+
+    def store(self, timestep, digest, frame):
+        """
+        Write the frame of a timestep rendered from inputs with hash `digest` to the store.
+        """
+        os.makedirs(self.frame_dir, exist_ok=True)
+        path = self.frame_path(timestep, digest)
+
+        # Written to a hidden temporary name and renamed, so a killed run never leaves a truncated frame
+        tmp_path = os.path.join(self.frame_dir, f".{os.path.basename(path)}.tmp.{os.getpid()}")
+        with stage('save'):
+            with open(tmp_path, 'wb') as f:
+                np.save(f, frame)
+            os.replace(tmp_path, path)
+        add('save', nbytes=frame.nbytes)
+
+    def record(self, timestep, digest):
+        """
+        Record the input hash of a frame of this run. Returns True if the frame was reused.
+        """
+        self.current[int(timestep)] = digest
+        return self.previous.get(int(timestep)) == digest
+
+    def save(self):
+        """
+        Write the manifest of this run, replacing the previous one atomically, and delete the frames
+        this run did not use, as well as the temporary frames left by runs killed while storing one.
+        """
+        os.makedirs(self.frame_dir, exist_ok=True)
+        tmp_path = f"{self.manifest_path}.tmp.{os.getpid()}"
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'version': MANIFEST_VERSION,
+                'params': self.params,
+                'frames': {str(timestep): digest for timestep, digest in sorted(self.current.items())}
+            }, f)
+        os.replace(tmp_path, self.manifest_path)
+
+        used = {self.frame_path(timestep, digest) for timestep, digest in self.current.items()}
+        for path in glob.glob(os.path.join(self.frame_dir, f"{glob.escape(self.prefix)}_timestep_*")):
+            if path not in used:
+                os.remove(path)
+        for path in glob.glob(os.path.join(self.frame_dir, f".{glob.escape(self.prefix)}_timestep_*.tmp.*")):
+            os.remove(path)
+
+
+def render_cached(timestep, inputs, render, store=None):
+    """
+    Function to return the frame of a timestep, rendering it only if the store has no valid copy.
+    `inputs` are the DataFrames the frame is rendered from and `render()` renders it.
+    Returns the frame and the content hash of the inputs (None without a store).
+    """
+    if store is None:
+        return render(), None
+
+    digest = content_digest(*inputs)
+    frame = store.load(timestep, digest)
+    if frame is None:
+        frame = render()
+        store.store(timestep, digest, frame)
+    return frame, digest
@@ -0,0 +1,263 @@
+import glob
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from multiprocessing import util
+
+# Environment variable naming the directory worker processes write their statistics to
+STATS_DIR_ENV = 'FLEE_STATS_DIR'
+
+# Order of the stages in the summary; other stages follow alphabetically
+STAGE_ORDER = ['setup', 'read', 'join', 'partition', 'load', 'aggregate', 'render', 'save', 'encode']
+
+# Recorder of this process
+_recorder = None
+
+
+def peak_rss():
+    """
+    Function to return the peak resident set size of this process so far, in bytes.
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class Recorder:
+    """
+    Recorder of the wall time, calls, rows and bytes of each stage in one process.
+    The peak RSS of a stage is the peak RSS of the process when the stage last finished.
+    """
+
+    def __init__(self, label=None):
+        self.pid = os.getpid()
+        self.label = label or f"pid {self.pid}"
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name, rows=0, nbytes=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, rows, nbytes)
+
+    def add(self, name, seconds=0.0, rows=0, nbytes=0):
+        """
+        Add time, rows or bytes to a stage.
+        """
+        entry = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0, 'rows': 0, 'bytes': 0, 'peak_rss': 0})
+        entry['seconds'] += seconds
+        entry['calls'] += 1 if seconds else 0
+        entry['rows'] += int(rows)
+        entry['bytes'] += int(nbytes)
+        entry['peak_rss'] = peak_rss()
+
+    def snapshot(self):
+        return {'worker': self.label, 'peak_rss': peak_rss(), 'stages': {k: dict(v) for k, v in self.stages.items()}}
+
+    def flush(self):
+        """
+        Write the statistics of this process to the directory shared by the main process, if any.
+        """
+        stats_dir = os.environ.get(STATS_DIR_ENV)
+        if not stats_dir or not self.stages:
+            return
+        path = os.path.join(stats_dir, f"{self.pid}.json")
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(f"{path}.tmp", path)
+
+
+def get_recorder():
+    """
+    Function to return the recorder of this process.
+    Forked workers start with an empty recorder, which writes its statistics when the worker exits.
+    """
+    global _recorder
+    if _recorder is None or _recorder.pid != os.getpid():
+        is_worker = _recorder is not None or os.environ.get(STATS_DIR_ENV) is not None
+        _recorder = Recorder()
+        if is_worker:
+            util.Finalize(_recorder, _recorder.flush, exitpriority=10)
+    return _recorder
+
+
+def stage(name, rows=0, nbytes=0):
+    """
+    Function to time a block of code as a stage of this process.
+    """
+    return get_recorder().stage(name, rows, nbytes)
+
+
+def add(name, rows=0, nbytes=0):
+    """
+    Function to add rows or bytes to a stage of this process without timing anything.
+    """
+    get_recorder().add(name, 0.0, rows, nbytes)
+
+
+def set_label(label):
+    """
+    Function to name this process in the summary, e.g. by its MPI rank.
+    """
+    get_recorder().label = label
+
+
+def start_workers():
+    """
+    Function to let the worker processes started from now on report their statistics to this process.
+    Returns the directory the statistics are collected in.
+    """
+    get_recorder()
+    stats_dir = tempfile.mkdtemp(prefix='flee_stats_')
+    os.environ[STATS_DIR_ENV] = stats_dir
+    return stats_dir
+
+
+def collect_workers(stats_dir):
+    """
+    Function to read the statistics written by the worker processes and remove the directory.
+    """
+    snapshots = []
+    for path in sorted(glob.glob(os.path.join(stats_dir, '*.json'))):
+        with open(path) as f:
+            snapshots.append(json.load(f))
+    shutil.rmtree(stats_dir, ignore_errors=True)
+    os.environ.pop(STATS_DIR_ENV, None)
+    return snapshots
+
+
+def summarize(snapshots, elapsed=None):
+    """
+    Function to aggregate the statistics of all processes per stage.
+    Seconds, rows and bytes are summed over processes; `max_seconds` is the slowest process.
+    """
+    totals = {}
+    for snapshot in snapshots:
+        for name, entry in snapshot['stages'].items():
+            total = totals.setdefault(
+                name, {'seconds': 0.0, 'max_seconds': 0.0, 'calls': 0, 'rows': 0, 'bytes': 0, 'peak_rss': 0}
+            )
+            total['seconds'] += entry['seconds']
+            total['max_seconds'] = max(total['max_seconds'], entry['seconds'])
+            total['calls'] += entry['calls']
+            total['rows'] += entry['rows']
+            total['bytes'] += entry['bytes']
+            total['peak_rss'] = max(total['peak_rss'], entry['peak_rss'])
+
+    order = {name: i for i, name in enumerate(STAGE_ORDER)}
+    stages = dict(sorted(totals.items(), key=lambda item: (order.get(item[0], len(order)), item[0])))
+    return {
+        'elapsed': elapsed,
+        'workers': len(snapshots),
+        'peak_rss': max((snapshot['peak_rss'] for snapshot in snapshots), default=0),
+        'stages': stages,
+        'per_worker': snapshots,
+    }
+
+
+def print_summary(summary, title="Run summary"):
+    """
+    Function to print the aggregated statistics as a table.
+    """
+    elapsed = f", {summary['elapsed']:.1f} s elapsed" if summary.get('elapsed') is not None else ""
+    print(f"{title}: {summary['workers']} processes{elapsed}, peak RSS {summary['peak_rss'] / 1024 ** 2:.0f} MB", flush=True)
+    print(
+        f"{'stage':<11} {'calls':>8} {'total [s]':>10} {'max [s]':>9} {'rows':>13} {'MB':>10} {'peak RSS [MB]':>14}",
+        flush=True
+    )
+    for name, entry in summary['stages'].items():
+        print(
+            f"{name:<11} {entry['calls']:>8} {entry['seconds']:>10.2f} {entry['max_seconds']:>9.2f} "
+            f"{entry['rows']:>13} {entry['bytes'] / 1024 ** 2:>10.1f} {entry['peak_rss'] / 1024 ** 2:>14.0f}",
+            flush=True
+        )
+
+
+def write_summary(summary, path):
+    """
+    Function to write the aggregated statistics to a JSON file.
+    """
+    with open(path, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+
+def report_workers(stats_dir, path, start_time=None, title="Run summary"):
+    """
+    Function to summarize this process and its multiprocessing workers, print the table and write the JSON.
+    """
+    snapshots = [get_recorder().snapshot()] + collect_workers(stats_dir)
+    snapshots[0]['worker'] = 'main'
+    summary = summarize(snapshots, time.perf_counter() - start_time if start_time is not None else None)
+    print_summary(summary, title)
+    write_summary(summary, path)
+    print(f"Run summary written to {path}", flush=True)
+
+
+def report_mpi(comm, path, start_time=None, title="Run summary"):
+    """
+    Function to gather the statistics of all MPI ranks on rank 0, print the table and write the JSON.
+    """
+    set_label(f"rank {comm.Get_rank()}")
+    snapshots = comm.gather(get_recorder().snapshot(), root=0)
+    if comm.Get_rank() == 0:
+        summary = summarize(snapshots, time.perf_counter() - start_time if start_time is not None else None)
+        print_summary(summary, title)
+        write_summary(summary, path)
+        print(f"Run summary written to {path}", flush=True)
+
+
+class Progress:
+    """
+    Progress meter for one process. On a terminal it updates a single line; in log files
+    it prints a line at every tenth of the work, so large runs do not flood the output.
+    With an unknown `total` (None), it counts the work done and logs every LOG_INTERVAL units.
+    """
+
+    # Units between two log lines when the total is unknown
+    LOG_INTERVAL = 100
+
+    def __init__(self, total, label, enabled=True, stream=None):
+        self.total = total
+        self.label = label
+        self.enabled = enabled and (total is None or total > 0)
+        self.stream = stream or sys.stderr
+        self.count = 0
+        self.start_time = time.perf_counter()
+        self._last_step = -1
+
+    def update(self, n=1):
+        if not self.enabled:
+            return
+        self.count += n
+        elapsed = time.perf_counter() - self.start_time
+        if self.total is None:
+            line = f"{self.label}: {self.count} {elapsed:.0f} s"
+            if self.stream.isatty():
+                print(f"\r{line}", end='', file=self.stream, flush=True)
+            elif self.count % self.LOG_INTERVAL == 0:
+                print(line, file=self.stream, flush=True)
+            return
+        line = f"{self.label}: {self.count}/{self.total} ({100 * self.count / self.total:.0f}%) {elapsed:.0f} s"
+        if self.stream.isatty():
+            end = '\n' if self.count >= self.total else ''
+            print(f"\r{line}", end=end, file=self.stream, flush=True)
+        else:
+            step = 10 * self.count // self.total
+            if step > self._last_step:
+                self._last_step = step
+                print(line, file=self.stream, flush=True)
+
+
+def starmap_progress(pool, func, iterable, progress):
+    """
+    Function to run `pool.starmap(func, iterable)` one task at a time, advancing a progress meter as tasks finish.
+    Results are returned in the order of `iterable`.
+    """
+    async_results = [pool.apply_async(func, args, callback=lambda result: progress.update()) for args in iterable]
+    return [async_result.get() for async_result in async_results]
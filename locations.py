@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+
+from instrumentation import stage
+
+# Location index of this process, shared once per worker
+_location_index = None
+
+
+class LocationIndex:
+    """
+    Index of the locations in input_csv/locations.csv: name -> integer id -> coordinate arrays.
+    Joins against the index are integer array lookups instead of pandas merges on string keys.
+    """
+
+    def __init__(self, names, latitude, longitude):
+        self.names = pd.Index(names)
+        self.latitude = np.asarray(latitude, dtype=float)
+        self.longitude = np.asarray(longitude, dtype=float)
+        self._projected = {}
+
+    @classmethod
+    def from_csv(cls, locations_file='input_csv/locations.csv'):
+        """
+        Build the index from a Flee locations file.
+        """
+        locations_df = pd.read_csv(locations_file, usecols=['#name', 'latitude', 'longitude'])
+        locations_df = locations_df.drop_duplicates(subset='#name')
+        return cls(locations_df['#name'].values, locations_df['latitude'].values, locations_df['longitude'].values)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getstate__(self):
+        # Projected coordinates belong to the renderers of one process
+        state = self.__dict__.copy()
+        state['_projected'] = {}
+        return state
+
+    def lookup(self, locations):
+        """
+        Map a Series of location names to integer ids, with -1 for unknown names.
+        Each unique name is looked up once and mapped back through the categorical codes.
+        """
+        with stage('join', rows=len(locations)):
+            values = locations.astype('category')
+            codes = values.cat.codes.to_numpy()
+            if len(values.cat.categories) == 0:
+                return np.full(len(codes), -1, dtype=np.int32)
+            category_ids = self.names.get_indexer(values.cat.categories)
+            return np.where(codes >= 0, category_ids[codes], -1).astype(np.int32)
+
+    def coordinates(self, ids):
+        """
+        Return the longitude and latitude arrays of location ids, with NaN for unknown ids.
+        """
+        return self._take(self.longitude, ids), self._take(self.latitude, ids)
+
+    def project(self, renderer, ids):
+        """
+        Return the projected x and y arrays of location ids in the map of a renderer.
+        All locations are projected once per renderer.
+        """
+        key = id(renderer)
+        if key not in self._projected:
+            self._projected[key] = renderer.project(self.longitude, self.latitude)
+        x, y = self._projected[key]
+        return self._take(x, ids), self._take(y, ids)
+
+    @staticmethod
+    def _take(values, ids):
+        ids = np.asarray(ids)
+        taken = np.asarray(values, dtype=float)[np.where(ids >= 0, ids, 0)] if len(values) else np.zeros(len(ids))
+        taken[ids < 0] = np.nan
+        return taken
+
+
+def set_location_index(index):
+    """
+    Function to share the location index with this process, e.g. as a Pool initializer.
+    """
+    global _location_index
+    _location_index = index
+
+
+def get_location_index():
+    """
+    Function to return the location index shared with this process.
+    """
+    return _location_index
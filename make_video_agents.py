@@ -1,6 +1,7 @@
 import os
 import glob
-from moviepy.editor import ImageSequenceClip
+
+from segments import encode_pngs_parallel
 
 
 if __name__ == "__main__":
@@ -14,10 +15,8 @@ if __name__ == "__main__":
     # Extract filenames (removing the path and the .png extension) for image files
     image_files = [os.path.basename(f) for f in matching_files]
     
-    # Create an animation
-    clip = ImageSequenceClip(image_files, fps=2)  # Adjust fps as needed
-
-    clip.write_videofile("agent_movements_animation.mp4", codec="libx264")
+    # Decode and encode segments of the PNGs on all cores, then join the segments without re-encoding
+    encode_pngs_parallel(image_files, "agent_movements_animation.mp4", fps=2)  # Adjust fps as needed
 
     print("Agents video created!", flush=True)
 
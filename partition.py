@@ -0,0 +1,202 @@
+import glob
+import json
+import os
+
+import pandas as pd
+
+from instrumentation import stage, add
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # Fall back to CSV part files when pyarrow is not installed
+    pq = None
+
+# Format of the part files
+PART_FORMAT = 'parquet' if pq is not None else 'csv'
+
+# Version of the partition layout, bumped whenever the stored columns change
+CACHE_VERSION = 4
+
+
+def file_key(path):
+    """
+    Function to return the (size, mtime) pair identifying the current content of a file.
+    """
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def timestep_dir(partition_dir, timestep):
+    """
+    Function to return the directory holding the part files of a timestep.
+    """
+    return os.path.join(partition_dir, f"timestep_{int(timestep):05d}")
+
+
+def manifest_path(partition_dir, source_file):
+    """
+    Function to return the path of the cache manifest of a rank file.
+    """
+    return os.path.join(partition_dir, 'sources', f"{os.path.basename(source_file)}.json")
+
+
+def is_cached(source_file, partition_dir, params=None):
+    """
+    Function to check whether the partitions of a rank file are up to date.
+    They are valid as long as the size and mtime of the file, the processing parameters and the
+    partition layout are unchanged.
+    """
+    try:
+        with open(manifest_path(partition_dir, source_file)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return manifest == {'version': CACHE_VERSION, 'key': file_key(source_file), 'params': params or {}}
+
+
+def mark_cached(source_file, partition_dir, params=None):
+    """
+    Function to record that the partitions of a rank file are complete.
+    The manifest is written to a temporary name and renamed, so an interrupted run never leaves a valid entry.
+    """
+    path = manifest_path(partition_dir, source_file)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'key': file_key(source_file), 'params': params or {}}, f)
+    os.replace(tmp_path, path)
+
+
+def drop_source(source_file, partition_dir):
+    """
+    Function to remove all part files and the manifest of a rank file.
+    """
+    source_name = glob.escape(os.path.basename(source_file))
+    for part_path in glob.glob(os.path.join(partition_dir, 'timestep_*', f"{source_name}.*")):
+        os.remove(part_path)
+    if os.path.exists(manifest_path(partition_dir, source_file)):
+        os.remove(manifest_path(partition_dir, source_file))
+
+
+def prune_sources(file_list, partition_dir):
+    """
+    Function to remove cached partitions of rank files that are no longer part of the output.
+    """
+    os.makedirs(partition_dir, exist_ok=True)
+    current = {os.path.basename(file) for file in file_list}
+    for path in glob.glob(os.path.join(partition_dir, 'sources', '*.json')):
+        source_name = os.path.basename(path)[:-len('.json')]
+        if source_name not in current:
+            drop_source(source_name, partition_dir)
+
+
+def mark_complete(units, results, partition_dir, params=None):
+    """
+    Function to mark rank files as cached once every byte range of them has been partitioned.
+    `units` are (file, start, end, range_index) tuples and `results` holds None for every failed unit.
+    Returns the list of completed files.
+    """
+    failed = {unit[0] for unit, result in zip(units, results) if result is None}
+    completed = []
+    for file in dict.fromkeys(unit[0] for unit in units):
+        if file not in failed:
+            mark_cached(file, partition_dir, params)
+            completed.append(file)
+    return completed
+
+
+class PartitionWriter:
+    """
+    Writer that stores the per-timestep batches of one rank file, or of one byte range of it, as part files.
+    A timestep may be written several times, e.g. when it spans several chunks of a streamed file.
+    """
+
+    def __init__(self, source_file, partition_dir, range_index=0):
+        self.source_name = os.path.basename(source_file)
+        self.partition_dir = partition_dir
+        self.range_index = range_index
+        self.batches = {}
+
+    def write(self, timestep, batch):
+        """
+        Write one batch of rows belonging to a single timestep.
+        """
+        timestep = int(timestep)
+        part_dir = timestep_dir(self.partition_dir, timestep)
+        os.makedirs(part_dir, exist_ok=True)
+
+        # One part per (timestep, rank file, byte range, batch), so writers never share a file
+        seq = self.batches.get(timestep, 0)
+        part_path = os.path.join(part_dir, f"{self.source_name}.{self.range_index}.{seq}.{PART_FORMAT}")
+        with stage('partition', rows=len(batch)):
+            if PART_FORMAT == 'parquet':
+                batch.to_parquet(part_path, index=False)
+            else:
+                batch.to_csv(part_path, index=False)
+        add('partition', nbytes=os.path.getsize(part_path))
+        self.batches[timestep] = seq + 1
+
+    @property
+    def timesteps(self):
+        return sorted(self.batches)
+
+
+def write_partitions(df, source_file, partition_dir, on_timestep=None):
+    """
+    Function to split the rows of one rank file by `#time` and write one part file per timestep.
+    `on_timestep(timestep)` is called before each timestep is written, in increasing order.
+    Returns the list of timesteps written.
+    """
+    writer = PartitionWriter(source_file, partition_dir)
+    for timestep, group in df.groupby('#time', sort=True):
+        if on_timestep is not None:
+            on_timestep(timestep)
+        writer.write(timestep, group)
+    return writer.timesteps
+
+
+def list_timesteps(partition_dir):
+    """
+    Function to list the timesteps for which at least one part file exists.
+    """
+    timesteps = []
+    for path in glob.glob(os.path.join(partition_dir, 'timestep_*')):
+        if glob.glob(os.path.join(path, f"*.{PART_FORMAT}")):
+            timesteps.append(int(os.path.basename(path).split('_')[-1]))
+    return sorted(timesteps)
+
+
+def load_timestep(partition_dir, timestep, columns=None):
+    """
+    Function to merge the part files of all rank files for a single timestep.
+    Parquet parts are memory-mapped, so only the requested timestep is read,
+    and with `columns` only those columns are read.
+    """
+    part_files = sorted(glob.glob(os.path.join(timestep_dir(partition_dir, timestep), f"*.{PART_FORMAT}")))
+    if not part_files:
+        return None
+    with stage('load', nbytes=sum(os.path.getsize(part_file) for part_file in part_files)):
+        if PART_FORMAT == 'parquet':
+            frames = [pq.read_table(part_file, columns=columns, memory_map=True).to_pandas() for part_file in part_files]
+        else:
+            frames = [pd.read_csv(part_file, usecols=columns) for part_file in part_files]
+        df = pd.concat(frames, ignore_index=True)
+    add('load', rows=len(df))
+    return df
+
+
+def timestep_bytes(partition_dir, timestep):
+    """
+    Function to return the total size of the part files of a timestep, as an estimate of its rendering cost.
+    """
+    part_files = glob.glob(os.path.join(timestep_dir(partition_dir, timestep), f"*.{PART_FORMAT}"))
+    return sum(os.path.getsize(part_file) for part_file in part_files)
+
+
+def timestep_key(partition_dir, timestep):
+    """
+    Function to return the (name, size, mtime) list identifying the current part files of a timestep,
+    e.g. to validate statistics derived from them.
+    """
+    part_files = sorted(glob.glob(os.path.join(timestep_dir(partition_dir, timestep), f"*.{PART_FORMAT}")))
+    return [[os.path.basename(part_file)] + file_key(part_file) for part_file in part_files]
@@ -0,0 +1,242 @@
+import heapq
+import math
+import multiprocessing
+import traceback
+from multiprocessing import Pool
+
+from partition import list_timesteps
+from readers import first_timestep
+from workers import init_worker
+
+# Maximum number of progress messages of the readers waiting for the main process;
+# readers block when it is full, so they never run far ahead of the scheduling of the renderers
+PROGRESS_QUEUE_SIZE = 1024
+
+# Progress queue, current work unit and last reported timestep of a reader process
+_queue = None
+_unit = None
+_last_timestep = None
+
+
+def init_reader(location_index, queue):
+    """
+    Function to set up a reader process of a pipelined run, as the Pool initializer.
+    """
+    global _queue
+    init_worker(location_index)
+    _queue = queue
+
+
+def report_timestep(timestep):
+    """
+    Function to report that the current work unit of this reader has reached a timestep, i.e. that it
+    will write no more rows of earlier timesteps. Does nothing outside the readers of a pipelined run.
+    """
+    global _last_timestep
+    if _queue is None or timestep == _last_timestep:
+        return
+    _last_timestep = timestep
+    _queue.put(('timestep', _unit, int(timestep)))
+
+
+def run_unit(task, position, args):
+    """
+    Function to run one partitioning unit on a reader and report its completion after all of its timesteps,
+    through the same queue, so that the main process sees them in order.
+    """
+    global _unit, _last_timestep
+    _unit = position
+    _last_timestep = None
+    result = None
+    try:
+        result = task(*args)
+    except Exception as e:
+        print(f"Error in partitioning unit {position}: {traceback.format_exc()}", flush=True)
+    finally:
+        _queue.put(('done', position, result))
+        _unit = None
+
+
+class Stages:
+    """
+    Worker counts of the stages of a pipelined run: reader processes that parse, join and partition
+    the rank files, renderer processes, and the encoder threads of ffmpeg. Counts that are not set
+    are derived from the size of the single pool of a phased run.
+    """
+
+    def __init__(self, read_workers=None, render_workers=None, encode_threads=None):
+        self.read_workers = read_workers
+        self.render_workers = render_workers
+        self.encode_threads = encode_threads
+
+    @classmethod
+    def from_args(cls, args):
+        """
+        Build the stages from the --pipeline, --read-workers, --render-workers and --encode-threads options;
+        None without --pipeline.
+        """
+        if not args.pipeline:
+            return None
+        return cls(args.read_workers, args.render_workers, args.encode_threads)
+
+    def resolve(self, num_workers):
+        """
+        Return the stages with the missing worker counts filled in, splitting `num_workers` between readers and renderers.
+        """
+        read_workers = self.read_workers or max(1, num_workers // 2)
+        render_workers = self.render_workers or max(1, num_workers - read_workers)
+        return Stages(read_workers, render_workers, self.encode_threads)
+
+
+class Watermark:
+    """
+    Lowest timestep that a running partitioning unit may still write rows for. Flee writes every rank file
+    in timestep order, so a unit that has reached timestep t writes no earlier rows, and a unit that has
+    not started yet begins at its first row, or no earlier than where the previous unit of the same file stopped.
+    Units are given as (source file, start offset) pairs, with the timesteps of their first rows if known.
+    """
+
+    def __init__(self, sources, first=None):
+        self.sources = [source for source, start in sources]
+        self.first = list(first) if first is not None else [None] * len(sources)
+        self.units = {}
+        for position, (source, start) in enumerate(sources):
+            self.units.setdefault(source, []).append((start, position))
+        for units in self.units.values():
+            units.sort()
+        self.current = [None] * len(sources)
+        self.done = [False] * len(sources)
+
+        # Watermark of every file that still has units running
+        self.file_low = {}
+        for source in self.units:
+            self._update_file(source)
+
+    def update(self, position, timestep):
+        self.current[position] = timestep
+        self._update_file(self.sources[position])
+
+    def finish(self, position):
+        self.done[position] = True
+        self._update_file(self.sources[position])
+
+    def _update_file(self, source):
+        reached = -math.inf
+        for start, position in self.units[source]:
+            if self.current[position] is not None:
+                reached = self.current[position]
+            elif self.first[position] is not None:
+                reached = max(reached, self.first[position])
+            if not self.done[position]:
+                self.file_low[source] = reached
+                return
+        self.file_low.pop(source, None)
+
+    def low(self):
+        """
+        Return the watermark: every timestep below it is complete. -inf while some file has not been reached.
+        """
+        return min(self.file_low.values(), default=math.inf)
+
+
+class TimestepFeed:
+    """
+    Iterator over the timesteps of a pipelined run, in increasing order. The partitioning units run on a
+    separate pool of readers, and every timestep is released as soon as all units have moved past it,
+    so rendering and encoding start while the files are still being read. Timesteps already partitioned
+    by earlier runs are included. `tasks` holds the arguments of `task` per unit and `sources` the
+    (source file, start offset) of each unit. Once all units are done, `on_complete(results)` is called
+    with their results in the order of `tasks`, before the last timesteps are released.
+    """
+
+    def __init__(self, num_readers, location_index, task, tasks, sources, partition_dirs, progress=None, on_complete=None):
+        self.partition_dirs = partition_dirs
+        self.watermark = Watermark(sources, [first_timestep(source, start) for source, start in sources])
+        self.progress = progress
+        self.on_complete = on_complete
+        self.results = [None] * len(tasks)
+        self.queue = multiprocessing.Queue(PROGRESS_QUEUE_SIZE)
+        self.pool = Pool(processes=num_readers, initializer=init_reader, initargs=(location_index, self.queue))
+        self.finished = False
+
+        # The first units of all files start first, so that the watermark rises as early as possible
+        rank = {}
+        for units in self.watermark.units.values():
+            for index, (start, position) in enumerate(units):
+                rank[position] = index
+        for position in sorted(range(len(tasks)), key=lambda position: (rank[position], position)):
+            self.pool.apply_async(run_unit, (task, position, tasks[position]))
+        self.pool.close()
+
+    def __iter__(self):
+        watermark = self.watermark
+        known = set()
+        for partition_dir in self.partition_dirs:
+            known.update(list_timesteps(partition_dir))
+        # Known timesteps not released yet, smallest first
+        pending = sorted(known)
+        released = -math.inf
+        remaining = len(self.results)
+
+        while remaining:
+            kind, position, value = self.queue.get()
+            if kind == 'timestep':
+                watermark.update(position, value)
+                if value not in known:
+                    known.add(value)
+                    heapq.heappush(pending, value)
+            else:
+                watermark.finish(position)
+                self.results[position] = value
+                remaining -= 1
+                if self.progress is not None:
+                    self.progress.update()
+
+            low = watermark.low()
+            while pending and pending[0] < low:
+                released = heapq.heappop(pending)
+                yield released
+
+        if self.on_complete is not None:
+            self.on_complete(self.results)
+        for partition_dir in self.partition_dirs:
+            known.update(list_timesteps(partition_dir))
+        self.finished = True
+        yield from sorted(timestep for timestep in known if timestep > released)
+
+    def close(self):
+        """
+        Wait for the readers to exit, or stop them if the run ended before all units were done.
+        """
+        if not self.finished:
+            self.pool.terminate()
+        self.pool.join()
+
+
+def add_pipeline_arguments(parser):
+    """
+    Function to add the --pipeline, --read-workers, --render-workers and --encode-threads options to an argument parser.
+    """
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Render and encode timesteps while the files are still being partitioned, on separate reader and renderer pools."
+    )
+    parser.add_argument(
+        "--read-workers",
+        type=int,
+        default=None,
+        help="Number of reader processes with --pipeline (default: half of the workers)."
+    )
+    parser.add_argument(
+        "--render-workers",
+        type=int,
+        default=None,
+        help="Number of renderer processes with --pipeline (default: the other half of the workers)."
+    )
+    parser.add_argument(
+        "--encode-threads",
+        type=int,
+        default=None,
+        help="Number of ffmpeg encoder threads with --pipeline (default: chosen by ffmpeg)."
+    )
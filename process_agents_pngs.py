@@ -2,104 +2,158 @@ from mpi4py import MPI
 import pandas as pd
 import glob
 import os
-import re
+import argparse
+import time
 import traceback
 
 # os.environ["MPLCONFIGDIR"] = "/work/e723/e723/mzr123/matplotlib_config"
 
-import matplotlib.pyplot as plt
-from mpl_toolkits.basemap import Basemap
+from renderer import get_renderer
+from locations import LocationIndex, set_location_index, get_location_index
+from aggregate import count_locations, count_cells, marker_sizes
+from readers import iter_agents_batches, plan_byte_ranges, DEFAULT_MEMORY_BUDGET
+from scheduler import schedule, report
+from instrumentation import Progress, report_mpi, set_label
+from checkpoint import Journal, resume_units
+from partition import (
+    PartitionWriter, file_key, is_cached, mark_complete, drop_source, prune_sources, list_timesteps, load_timestep,
+    timestep_bytes
+)
 
 # Initialize MPI
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
 
-def process_file(file):
+# Static legend entries of the agents frames
+LEGEND = [
+    {'marker': '*', 'color': 'red', 'label': 'Original Locations', 's': 90, 'alpha': 0.7},
+    {'marker': 'o', 'color': 'green', 'label': 'Current Locations', 's': 50, 'alpha': 0.3},
+]
+
+def process_file(file, memory_budget=DEFAULT_MEMORY_BUDGET, byte_range=None):
     """
-    Function to process a single file and return a DataFrame.
+    Function to stream a single file, or one byte range of it, as per-timestep batches of the essential columns.
     """
     try:
-        # Read the file
-        df = pd.read_csv(file, index_col=False)
-        df.index.name = 'Index'
-
-        # Drop unnecessary columns and keep only the essentials
-        df = df[['#time', 'original_location', 'gps_x', 'gps_y', 'current_location']]
-
-        # Drop rows with NaN values
-        df = df.dropna()
-
-        # Optionally downsample rows
-        df = df.iloc[::16, :]  # Take every 16th row
-
-        return df
+        for timestep, df in iter_agents_batches(file, memory_budget, byte_range):
+            yield timestep, df
     except pd.errors.EmptyDataError:
         print(f"Rank {rank}: Skipping empty file: {file}", flush=True)
-        return None
-    except Exception as e:
-        print(f"Rank {rank}: Error processing file {file}: {e}", flush=True)
-        return None
 
-def clean_location(x):
+def png_path(output_dir, timestep):
     """
-    Function to clean location strings.
+    Function to return the path of the PNG of a timestep.
     """
-    if isinstance(x, str):
-        return re.sub(r'L:.*?:', '', x)
-    print(f"Skipping invalid value: {x}", flush=True)
-    return None
+    return os.path.join(output_dir, f"agents_timestep_{timestep:03d}.png")
 
 def plot_timestep(timestep, agents_data, output_dir):
     """
     Function to generate a PNG for a given timestep.
     """
     try:
-        plt.figure(figsize=(12, 8))
-        m = Basemap(projection='merc', llcrnrlat=4, urcrnrlat=14, llcrnrlon=2, urcrnrlon=15, resolution='i')
-        m.drawcountries()
-        m.drawcoastlines()
-
-        original_locations = agents_data[agents_data['#time'] == timestep]
-        m.scatter(
-            original_locations['gps_x0'].values,
-            original_locations['gps_y0'].values,
-            latlon=True,
+        renderer = get_renderer('agents', legend=LEGEND)
+        index = get_location_index()
+
+        # Aggregate the agents of this timestep, so one marker is drawn per occupied location or grid cell
+        timestep_data = agents_data[agents_data['#time'] == timestep]
+        original_ids, _ = count_locations(timestep_data['original_id'].values, len(index))
+        current_lon, current_lat, current_counts = count_cells(timestep_data['gps_y'].values, timestep_data['gps_x'].values)
+
+        original_x, original_y = index.project(renderer, original_ids)
+        renderer.scatter_xy(
+            original_x,
+            original_y,
             marker='*',
             color='red',
-            label='Original Locations',
             s=90,
             alpha=0.7,
             zorder=3
         )
 
-        current_locations = agents_data[agents_data['#time'] == timestep]
-        m.scatter(
-            current_locations['gps_y'].values,
-            current_locations['gps_x'].values,
-            latlon=True,
+        # Marker sizes follow the exact number of agents in each cell
+        renderer.scatter(
+            current_lon,
+            current_lat,
             marker='o',
             color='green',
-            label='Current Locations',
-            s=50,
+            s=marker_sizes(current_counts, min_size=50, max_size=500),
             alpha=0.3,
             zorder=2
         )
 
-        #plt.title(f"Agent Movements at Timestep {timestep}")
-        plt.legend(loc='lower left')
-        output_path = os.path.join(output_dir, f"agents_timestep_{timestep:03d}.png")
-        plt.savefig(output_path)
-        plt.close()
+        output_path = png_path(output_dir, timestep)
+        renderer.save(renderer.render(), output_path)
         return output_path
     except Exception as e:
         print(f"Error in plot_timestep for timestep {timestep}: {traceback.format_exc()}")
         raise
 
+def partition_range(file, start, end, range_index, partition_dir, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """
+    Function to stream one byte range of a file and write its rows into per-timestep partitions.
+    Returns the number of rows written, or None if the range could not be processed.
+    """
+    try:
+        index = get_location_index()
+        writer = PartitionWriter(file, partition_dir, range_index)
+        rows = 0
+        for timestep, df in process_file(file, memory_budget, (start, end)):
+            # Replace the origin names by their location ids; agents are drawn at their GPS positions,
+            # so the current location is not needed
+            df['original_id'] = index.lookup(df['original_location'])
+            df = df.drop(columns=['original_location', 'current_location'])
+
+            writer.write(timestep, df)
+            rows += len(df)
+
+        return rows
+    except Exception as e:
+        print(f"Rank {rank}: Error processing range {range_index} of file {file}: {e}", flush=True)
+        return None
+
+def render_partition(timestep, partition_dir, output_dir):
+    """
+    Function to load the merged partitions of a timestep and generate its PNG.
+    Returns the path of the PNG, or None if the timestep has no rows.
+    """
+    df = load_timestep(partition_dir, timestep)
+    if df is not None:
+        return plot_timestep(timestep, df, output_dir)
+    return None
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render agents PNGs from Flee agents.out.* files with MPI.")
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=DEFAULT_MEMORY_BUDGET // 1024 ** 2,
+        help="Memory budget of the streaming reader of each rank, in MB."
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Only render the timesteps whose PNGs are missing or incomplete after an interrupted run."
+    )
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        help="Show a progress meter of each phase on rank 0."
+    )
+    parser.add_argument(
+        "--summary",
+        type=str,
+        default="agents_run_summary.json",
+        help="Path of the JSON summary of the per-stage timings of all ranks."
+    )
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    set_label(f"rank {rank}")
     try:
         # Create output directory for PNGs, optionally
         output_dir = "."
+        partition_dir = os.path.join("flee_partitions", "agents")
         if rank == 0:
             os.makedirs(output_dir, exist_ok=True)
 
@@ -108,52 +162,101 @@ if __name__ == "__main__":
         # Master rank gathers the file list
         if rank == 0:
             file_list = sorted(glob.glob('agents.out.*'), key=lambda x: int(x.split('.')[-1]))
+
+            # Partitions of earlier runs are reused, except for files that no longer exist
+            prune_sources(file_list, partition_dir)
+
+            # Reuse the cached partitions of files that changed neither themselves nor the locations
+            params = {'locations': file_key('input_csv/locations.csv')}
+            pending_files = []
+            for file in file_list:
+                if not is_cached(file, partition_dir, params):
+                    drop_source(file, partition_dir)
+                    pending_files.append(file)
+            if len(pending_files) < len(file_list):
+                print(f"Rank {rank}: Using cached partitions of {len(file_list) - len(pending_files)} of {len(file_list)} files", flush=True)
+
+            # Split the files into newline-aligned byte ranges, so that all ranks have work
+            # even when there are fewer files than ranks
+            units = plan_byte_ranges(pending_files, 4 * size)
         else:
-            file_list = None
+            units = None
 
-        # Broadcast file list to all ranks
-        file_list = comm.bcast(file_list, root=0)
+        # Broadcast the work units to all ranks
+        units = comm.bcast(units, root=0)
 
-        # Distribute files across processors
-        num_files = len(file_list)
-        files_per_rank = num_files // size
-        remainder = num_files % size
+        # Build the location index on the master rank and broadcast it to all ranks
+        location_index = LocationIndex.from_csv('input_csv/locations.csv') if rank == 0 else None
+        set_location_index(comm.bcast(location_index, root=0))
+
+        # Phase 1: repartition the rows of every byte range by timestep; ranks take the largest remaining range when free
+        memory_budget = args.memory_budget * 1024 ** 2
+        results = [None] * len(units)
+        progress = Progress(len(units), "Partitioning", args.progress and rank == 0)
+
+        def record_result(position, result):
+            results[position] = result
+            progress.update()
+
+        stats = schedule(
+            comm,
+            units,
+            lambda unit: partition_range(*unit, partition_dir, memory_budget),
+            costs=[end - start for file, start, end, range_index in units],
+            on_result=record_result
+        )
+        if rank == 0:
+            report(stats, "Partitioning")
 
-        if rank < remainder:
-            start_idx = rank * (files_per_rank + 1)
-            end_idx = start_idx + files_per_rank + 1
+            # Files are cached only once all of their byte ranges are partitioned
+            mark_complete(units, results, partition_dir, params)
+
+            timesteps = list_timesteps(partition_dir)
+
+            # Completed timesteps are journaled, so that a resubmitted job only renders the missing PNGs;
+            # the journal is only reused if neither the input files nor the locations changed
+            journal = Journal(
+                os.path.join("flee_checkpoints", "agents_pngs.journal"),
+                {'sources': {file: file_key(file) for file in file_list}, 'params': params, 'output_dir': output_dir}
+            )
+            if args.resume:
+                num_timesteps = len(timesteps)
+                timesteps = resume_units(journal, timesteps, lambda timestep: png_path(output_dir, timestep))
+                print(f"Rank {rank}: Resuming with {len(timesteps)} of {num_timesteps} timesteps to render", flush=True)
+            else:
+                journal.start()
+            timestep_sizes = [timestep_bytes(partition_dir, timestep) for timestep in timesteps]
         else:
-            start_idx = rank * files_per_rank + remainder
-            end_idx = start_idx + files_per_rank
-
-        assigned_files = file_list[start_idx:end_idx]
-        print(f"Rank {rank}: Assigned {len(assigned_files)} files.", flush=True)
-
-        # Process assigned files and generate PNGs
-        for file in assigned_files:
-            df = process_file(file)
-            if df is not None:
-                # Clean `current_location` column
-                df['current_location_clean'] = df['current_location'].apply(clean_location)
-
-                # Add original location coordinates
-                locations_df = pd.read_csv('input_csv/locations.csv')
-                df = df.merge(
-                    locations_df[['#name', 'latitude', 'longitude']].rename(
-                        columns={'#name': 'original_location', 'latitude': 'gps_y0', 'longitude': 'gps_x0'}
-                    ),
-                    on='original_location',
-                    how='left'
-                )
-
-                # Generate PNGs for each timestep in this file
-                for timestep in sorted(df['#time'].unique()):
-                    plot_timestep(timestep, df, output_dir)
-                    print(f"Rank {rank}: Generated PNG for timestep {timestep} from file {file}", flush=True)
+            timesteps = None
+            timestep_sizes = None
+
+        timesteps = comm.bcast(timesteps, root=0)
+        timestep_sizes = comm.bcast(timestep_sizes, root=0)
+
+        # Phase 2: render each timestep once from the merged partitions, also load balanced by bytes
+        progress = Progress(len(timesteps), "Rendering", args.progress and rank == 0)
+
+        def record_timestep(position, result):
+            progress.update()
+            if result is not None:
+                journal.record(timesteps[position])
+
+        stats = schedule(
+            comm,
+            timesteps,
+            lambda timestep: render_partition(timestep, partition_dir, output_dir),
+            costs=timestep_sizes,
+            on_result=record_timestep
+        )
+        if rank == 0:
+            journal.close()
+            report(stats, "Rendering")
+
+        # Gather the per-stage timings of all ranks into one summary
+        report_mpi(comm, args.summary, start_time)
 
         comm.Barrier()
         if rank == 0:
             print("All ranks completed PNG generation successfully.", flush=True)
     except Exception as e:
         print(f"Rank {rank}: Error occurred: {traceback.format_exc()}")
-
@@ -1,51 +1,40 @@
 import pandas as pd
 import glob
 import os
-import re
+import argparse
+import time
 import traceback
 from multiprocessing import Pool, cpu_count
 
 # os.environ["MPLCONFIGDIR"] = "/work/e723/e723/mzr123/matplotlib_config"
 
-import matplotlib.pyplot as plt
-from mpl_toolkits.basemap import Basemap
+from renderer import get_renderer
+from locations import LocationIndex, get_location_index
+from aggregate import count_locations, count_cells, marker_sizes
+from readers import iter_agents_batches, plan_byte_ranges, DEFAULT_MEMORY_BUDGET
+from partition import (
+    PartitionWriter, file_key, is_cached, mark_complete, drop_source, prune_sources, list_timesteps, load_timestep
+)
+from instrumentation import Progress, start_workers, report_workers, starmap_progress
+from workers import init_worker, worker_count, BASE_WORKER_MEMORY, RENDERER_MEMORY
 
 
-def process_file(file):
+# Static legend entries of the agents frames
+LEGEND = [
+    {'marker': '*', 'color': 'red', 'label': 'Original Locations', 's': 90, 'alpha': 0.7},
+    {'marker': 'o', 'color': 'green', 'label': 'Current Locations', 's': 50, 'alpha': 0.3},
+]
+
+
+def process_file(file, memory_budget=DEFAULT_MEMORY_BUDGET, byte_range=None):
     """
-    Function to process a single file and return a DataFrame.
+    Function to stream a single file, or one byte range of it, as per-timestep batches of the essential columns.
     """
     try:
-        # Read the file
-        df = pd.read_csv(file, index_col=False)
-        df.index.name = 'Index'
-
-        # Drop unnecessary columns and keep only the essentials
-        df = df[['#time', 'original_location', 'gps_x', 'gps_y', 'current_location']]
-
-        # Drop rows with NaN values
-        df = df.dropna()
-
-        # Optionally downsample rows
-        df = df.iloc[::16, :]  # Take every 16th row
-
-        return df
+        for timestep, df in iter_agents_batches(file, memory_budget, byte_range):
+            yield timestep, df
     except pd.errors.EmptyDataError:
         print(f"Skipping empty file: {file}", flush=True)
-        return None
-    except Exception as e:
-        print(f"Error processing file {file}: {e}", flush=True)
-        return None
-
-
-def clean_location(x):
-    """
-    Function to clean location strings.
-    """
-    if isinstance(x, str):
-        return re.sub(r'L:.*?:', '', x)
-    print(f"Skipping invalid value: {x}", flush=True)
-    return None
 
 
 def plot_timestep(timestep, agents_data, output_dir):
@@ -53,76 +42,102 @@ def plot_timestep(timestep, agents_data, output_dir):
     Function to generate a PNG for a given timestep.
     """
     try:
-        plt.figure(figsize=(12, 8))
-        m = Basemap(projection='merc', llcrnrlat=4, urcrnrlat=14, llcrnrlon=2, urcrnrlon=15, resolution='i')
-        m.drawcountries()
-        m.drawcoastlines()
-
-        original_locations = agents_data[agents_data['#time'] == timestep]
-        m.scatter(
-            original_locations['gps_x0'].values,
-            original_locations['gps_y0'].values,
-            latlon=True,
+        renderer = get_renderer('agents', legend=LEGEND)
+        index = get_location_index()
+
+        # Aggregate the agents of this timestep, so one marker is drawn per occupied location or grid cell
+        timestep_data = agents_data[agents_data['#time'] == timestep]
+        original_ids, _ = count_locations(timestep_data['original_id'].values, len(index))
+        current_lon, current_lat, current_counts = count_cells(timestep_data['gps_y'].values, timestep_data['gps_x'].values)
+
+        original_x, original_y = index.project(renderer, original_ids)
+        renderer.scatter_xy(
+            original_x,
+            original_y,
             marker='*',
             color='red',
-            label='Original Locations',
             s=90,
             alpha=0.7,
             zorder=3
         )
 
-        current_locations = agents_data[agents_data['#time'] == timestep]
-        m.scatter(
-            current_locations['gps_y'].values,
-            current_locations['gps_x'].values,
-            latlon=True,
+        # Marker sizes follow the exact number of agents in each cell
+        renderer.scatter(
+            current_lon,
+            current_lat,
             marker='o',
             color='green',
-            label='Current Locations',
-            s=50,
+            s=marker_sizes(current_counts, min_size=50, max_size=500),
             alpha=0.3,
             zorder=2
         )
 
-        plt.legend(loc='lower left')
         output_path = os.path.join(output_dir, f"agents_timestep_{timestep:03d}.png")
-        plt.savefig(output_path)
-        plt.close()
+        renderer.save(renderer.render(), output_path)
         return output_path
     except Exception as e:
         print(f"Error in plot_timestep for timestep {timestep}: {traceback.format_exc()}")
         raise
 
 
-def process_and_plot(file):
+def partition_range(file, start, end, range_index, partition_dir, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """
+    Function to stream one byte range of a file and write its rows into per-timestep partitions.
+    Returns the number of rows written, or None if the range could not be processed.
+    """
+    try:
+        index = get_location_index()
+        writer = PartitionWriter(file, partition_dir, range_index)
+        rows = 0
+        for timestep, df in process_file(file, memory_budget, (start, end)):
+            # Replace the origin names by their location ids; agents are drawn at their GPS positions,
+            # so the current location is not needed
+            df['original_id'] = index.lookup(df['original_location'])
+            df = df.drop(columns=['original_location', 'current_location'])
+
+            writer.write(timestep, df)
+            rows += len(df)
+
+        return rows
+    except Exception as e:
+        print(f"Error in processing range {range_index} of file {file}: {traceback.format_exc()}")
+        return None
+
+
+def plot_partition(timestep, partition_dir, output_dir):
     """
-    Function to process a file and generate PNGs for all timesteps in it.
+    Function to generate the PNG for a timestep from the rows of all files.
     """
     try:
-        df = process_file(file)
+        df = load_timestep(partition_dir, timestep)
         if df is not None:
-            # Clean `current_location` column
-            df['current_location_clean'] = df['current_location'].apply(clean_location)
-
-            # Add original location coordinates
-            locations_df = pd.read_csv('input_csv/locations.csv')
-            df = df.merge(
-                locations_df[['#name', 'latitude', 'longitude']].rename(
-                    columns={'#name': 'original_location', 'latitude': 'gps_y0', 'longitude': 'gps_x0'}
-                ),
-                on='original_location',
-                how='left'
-            )
-
-            # Generate PNGs for each timestep in this file
-            for timestep in sorted(df['#time'].unique()):
-                plot_timestep(timestep, df, output_dir)
-                print(f"Generated PNG for timestep {timestep} from file {file}", flush=True)
+            plot_timestep(timestep, df, output_dir)
     except Exception as e:
-        print(f"Error in processing file {file}: {traceback.format_exc()}")
+        print(f"Error in plotting timestep {timestep}: {traceback.format_exc()}")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render agents PNGs from Flee agents.out.* files.")
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=DEFAULT_MEMORY_BUDGET // 1024 ** 2,
+        help="Memory budget of the streaming reader of each worker, in MB."
+    )
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        help="Show a progress meter of each phase."
+    )
+    parser.add_argument(
+        "--summary",
+        type=str,
+        default="agents_run_summary.json",
+        help="Path of the JSON summary of the per-stage timings of all workers."
+    )
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
     try:
         # Create output directory for PNGs
         output_dir = "./output_agents_pngs"
@@ -131,22 +146,72 @@ if __name__ == "__main__":
         # Gather all log files
         file_list = sorted(glob.glob('agents.out.*'), key=lambda x: int(x.split('.')[-1]))
 
-        # Use multiprocessing to parallelize file processing
-        num_workers = min(cpu_count(), len(file_list))  # Use available CPUs or the number of files, whichever is smaller
-        
-        print(f"Found {len(file_list)} files and {num_workers} workers to process.")
-            
-        with Pool(processes=num_workers) as pool:
+        # Partitions of earlier runs are reused, except for files that no longer exist
+        partition_dir = os.path.join("flee_partitions", "agents")
+        prune_sources(file_list, partition_dir)
+
+        # Build the location index once and share it with every worker
+        location_index = LocationIndex.from_csv('input_csv/locations.csv')
+
+        # Reuse the cached partitions of files that changed neither themselves nor the locations
+        params = {'locations': file_key('input_csv/locations.csv')}
+        pending_files = []
+        for file in file_list:
+            if not is_cached(file, partition_dir, params):
+                drop_source(file, partition_dir)
+                pending_files.append(file)
+        if len(pending_files) < len(file_list):
+            print(f"Using cached partitions of {len(file_list) - len(pending_files)} of {len(file_list)} files", flush=True)
+
+        # Phase 1: split the files into newline-aligned byte ranges, so that all CPUs parse in parallel
+        # even when there are fewer files than CPUs, and repartition their rows by timestep
+        units = plan_byte_ranges(pending_files, 4 * cpu_count())
+        units.sort(key=lambda unit: unit[2] - unit[1], reverse=True)  # Largest ranges first
+
+        # One pool serves both phases; each worker holds a streaming reader and a warm renderer
+        memory_budget = args.memory_budget * 1024 ** 2
+        num_workers = worker_count(BASE_WORKER_MEMORY + RENDERER_MEMORY + memory_budget)
+
+        print(f"Found {len(file_list)} files, {len(units)} byte ranges to parse and {num_workers} workers to process.")
+
+        # Workers started from now on report their per-stage timings when they exit
+        stats_dir = start_workers()
+
+        renderers = {'agents': {'legend': LEGEND}}
+        with Pool(processes=num_workers, initializer=init_worker, initargs=(location_index, renderers)) as pool:
             try:
-                # Map the processing function across files
-                pool.map(process_and_plot, file_list)
-            except Exception as e:
-                print(f"Error occurred during multiprocessing: {e}", flush=True)
+                results = [None] * len(units)
+                try:
+                    results = starmap_progress(
+                        pool,
+                        partition_range,
+                        [(file, start, end, range_index, partition_dir, memory_budget)
+                         for file, start, end, range_index in units],
+                        Progress(len(units), "Partitioning", args.progress)
+                    )
+                except Exception as e:
+                    print(f"Error occurred during multiprocessing: {e}", flush=True)
+
+                # Files are cached only once all of their byte ranges are partitioned
+                mark_complete(units, results, partition_dir, params)
+
+                # Phase 2: render each timestep once from the merged partitions, on the same warm workers
+                timesteps = list_timesteps(partition_dir)
+                print(f"Found {len(timesteps)} timesteps and {num_workers} workers to render.")
+
+                try:
+                    progress = Progress(len(timesteps), "Rendering", args.progress)
+                    starmap_progress(pool, plot_partition, [(timestep, partition_dir, output_dir) for timestep in timesteps], progress)
+                except Exception as e:
+                    print(f"Error occurred during multiprocessing: {e}", flush=True)
             finally:
                 # Ensure the pool is closed and joined properly
                 pool.close()
                 pool.join()
 
+        # Summarize the per-stage timings of this process and all workers
+        report_workers(stats_dir, args.summary, start_time)
+
         print("All files processed and PNGs generated successfully.")
     except Exception as e:
         print(f"Error occurred: {traceback.format_exc()}")
@@ -1,14 +1,30 @@
 from mpi4py import MPI
+import numpy as np
 import pandas as pd
 import glob
 import os
+import argparse
+import time
 import traceback
 
 # os.environ["MPLCONFIGDIR"] = "/work/e723/e723/mzr123/matplotlib_config"
 
 import matplotlib.pyplot as plt
 from matplotlib import colors
-from mpl_toolkits.basemap import Basemap
+
+from renderer import MapRenderer, get_renderer, dpi_for_sizes
+from encoder import OutputProfile, open_profiles
+from reorder import mpi_render_ordered
+from segments import mpi_render_segmented, segment_length
+from scheduler import schedule, report
+from instrumentation import Progress, report_mpi, set_label, stage, add
+from checkpoint import Journal, resume_units
+from locations import LocationIndex, set_location_index, get_location_index
+from aggregate import sum_edges
+from partition import (
+    write_partitions, file_key, is_cached, mark_cached, drop_source, prune_sources, list_timesteps, load_timestep,
+    timestep_bytes
+)
 
 # Initialize MPI
 comm = MPI.COMM_WORLD
@@ -20,7 +36,9 @@ def process_file(file):
     Process a single file and return a DataFrame.
     """
     try:
-        df = pd.read_csv(file, index_col=False)
+        with stage('read', nbytes=os.path.getsize(file)):
+            df = pd.read_csv(file, index_col=False)
+        add('read', rows=len(df))
         df.index.name = 'Index'
         
         # Drop rows with NaN values
@@ -34,15 +52,14 @@ def process_file(file):
         print(f"Rank {rank}: Error processing file {file}: {e}", flush=True)
         return None
 
-def plot_timestep(timestep, links_data, output_dir):
+def render_timestep(timestep, links_data):
     """
-    Generate a PNG for a given timestep.
+    Render the frame of a given timestep.
     """
     try:
-        plt.figure(figsize=(12, 8))
-        m = Basemap(projection='merc', llcrnrlat=4, urcrnrlat=14, llcrnrlon=2, urcrnrlon=15, resolution='i')
-        m.drawcountries()
-        m.drawcoastlines()
+        # Reuse the projection and background of this process
+        renderer = get_renderer('links')
+        index = get_location_index()
 
         # Filter data for this timestep
         timestep_data = links_data[links_data['#time'] == timestep]
@@ -51,36 +68,157 @@ def plot_timestep(timestep, links_data, output_dir):
         cmap = plt.colormaps['coolwarm']
         norm = colors.Normalize(vmin=0, vmax=1000)
 
-        # Plot connections between locations
-        for _, row in timestep_data.iterrows():
-            norm_value = norm(min(row['cum_num_agents'], 1000))  # Cap value at 1000
-            link_color = cmap(norm_value)
-            capped_value = min(row['cum_num_agents'], 1000)
-            linewidth = min(0.5 + 0.005 * capped_value, 3.0)
-
-            m.plot(
-                [row['start_lon'], row['end_lon']],
-                [row['start_lat'], row['end_lat']],
-                latlon=True,
-                color=link_color,
-                label='Routes',
-                alpha=0.4,
-                linewidth=linewidth
-            )
-
-        #plt.title(f"Agent Movements Links at Timestep {timestep}")
-        output_path = os.path.join(output_dir, f"links_timestep_{timestep:03d}.png")
-        plt.savefig(output_path)
-        plt.close()
-        return output_path
+        # Sum the partial counts of each link over all rank files, so every link is drawn once
+        start_ids, end_ids, link_counts = sum_edges(
+            timestep_data['start_id'].values, timestep_data['end_id'].values, timestep_data['cum_num_agents'].values, len(index)
+        )
+
+        # Colors and widths for all links at once
+        capped_values = np.minimum(link_counts, 1000)  # Cap values at 1000
+        link_colors = cmap(norm(capped_values))
+        linewidths = np.minimum(0.5 + 0.005 * capped_values, 3.0)
+
+        # Projected start and end points of all links
+        start_x, start_y = index.project(renderer, start_ids)
+        end_x, end_y = index.project(renderer, end_ids)
+
+        # Plot connections between locations as a single collection
+        renderer.lines(
+            start_x,
+            start_y,
+            end_x,
+            end_y,
+            colors=link_colors,
+            alpha=0.4,
+            linewidths=linewidths
+        )
+
+        return renderer.render()
     except Exception as e:
-        print(f"Error in plot_timestep for timestep {timestep}: {traceback.format_exc()}", flush=True)
+        print(f"Error in render_timestep for timestep {timestep}: {traceback.format_exc()}", flush=True)
         raise
 
+def png_path(output_dir, timestep):
+    """
+    Return the path of the PNG of a timestep.
+    """
+    return os.path.join(output_dir, f"links_timestep_{timestep:03d}.png")
+
+def plot_timestep(timestep, links_data, output_dir):
+    """
+    Generate a PNG for a given timestep.
+    """
+    output_path = png_path(output_dir, timestep)
+    MapRenderer.save(render_timestep(timestep, links_data), output_path)
+    return output_path
+
+def render_partition(timestep, partition_dir, png_dir=None):
+    """
+    Render a timestep from its partitions, optionally saving it as a PNG, and return (timestep, frame).
+    """
+    try:
+        df = load_timestep(partition_dir, timestep)
+        if df is None:
+            return timestep, None
+        frame = render_timestep(timestep, df)
+        if png_dir is not None:
+            MapRenderer.save(frame, png_path(png_dir, timestep))
+        return timestep, frame
+    except Exception as e:
+        print(f"Rank {rank}: Error in rendering timestep {timestep}: {traceback.format_exc()}", flush=True)
+        return timestep, None
+
+def partition_file(file, partition_dir):
+    """
+    Process a file and split its rows into per-timestep partitions.
+    """
+    # Reuse the cached partitions if neither the file nor the locations changed
+    params = {'locations': file_key('input_csv/locations.csv')}
+    if is_cached(file, partition_dir, params):
+        return
+    drop_source(file, partition_dir)
+
+    df = process_file(file)
+    if df is not None:
+        # Look up the location ids of the start and end locations
+        index = get_location_index()
+        df['start_id'] = index.lookup(df['start_location'])
+        df['end_id'] = index.lookup(df['end_location'])
+        df = df[['#time', 'start_id', 'end_id', 'cum_num_agents']]
+
+        # Repartition the rows of this file by timestep
+        write_partitions(df, file, partition_dir)
+        mark_cached(file, partition_dir, params)
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process Flee links.out.* files to generate PNGs or a video.")
+    parser.add_argument(
+        "--video",
+        type=str,
+        default=None,
+        help="Write the frames in timestep order to this video file on rank 0."
+    )
+    parser.add_argument(
+        "--no-pngs",
+        action="store_true",
+        help="Do not write PNG files when writing a video."
+    )
+    parser.add_argument(
+        "--fps",
+        type=int,
+        default=2,
+        help="Frame rate of the video."
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        action="append",
+        default=None,
+        metavar="NAME:WIDTHxHEIGHT[:fps=N][:codec=CODEC][:crf=N]",
+        help="Write the video in this size and quality to <video>_NAME.mp4, e.g. preview:640x360:crf=30. "
+             "May be repeated; every profile is encoded from the same rendered frames. Default: --video at the rendered size."
+    )
+    parser.add_argument(
+        "--segmented",
+        action="store_true",
+        help="Encode segments of the video in parallel on the ranks and join them on rank 0 without re-encoding."
+    )
+    parser.add_argument(
+        "--segment-frames",
+        type=int,
+        default=None,
+        help="Number of frames per segment with --segmented (default: several whole GOPs per rank)."
+    )
+    parser.add_argument(
+        "--max-pending",
+        type=int,
+        default=None,
+        help="Maximum number of frames rendered ahead of the video writer (default: twice the number of ranks)."
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Only render the timesteps whose PNGs are missing or incomplete after an interrupted run (PNG mode only)."
+    )
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        help="Show a progress meter of each phase on rank 0."
+    )
+    parser.add_argument(
+        "--summary",
+        type=str,
+        default="links_run_summary.json",
+        help="Path of the JSON summary of the per-stage timings of all ranks."
+    )
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    set_label(f"rank {rank}")
     try:
         # Create output directory for PNGs, optionally
         output_dir = "."
+        partition_dir = os.path.join("flee_partitions", "links")
         if rank == 0:
             os.makedirs(output_dir, exist_ok=True)
 
@@ -89,63 +227,114 @@ if __name__ == "__main__":
         # Master rank gathers the file list
         if rank == 0:
             file_list = sorted(glob.glob('links.out.*'), key=lambda x: int(x.split('.')[-1]))
+
+            # Partitions of earlier runs are reused, except for files that no longer exist
+            prune_sources(file_list, partition_dir)
+            file_sizes = [os.path.getsize(file) for file in file_list]
         else:
             file_list = None
+            file_sizes = None
 
         # Broadcast file list to all ranks
         file_list = comm.bcast(file_list, root=0)
+        file_sizes = comm.bcast(file_sizes, root=0)
 
-        # Distribute files across processors
-        num_files = len(file_list)
-        files_per_rank = num_files // size
-        remainder = num_files % size
+        # Build the location index on the master rank and broadcast it to all ranks
+        location_index = LocationIndex.from_csv('input_csv/locations.csv') if rank == 0 else None
+        set_location_index(comm.bcast(location_index, root=0))
 
-        if rank < remainder:
-            start_idx = rank * (files_per_rank + 1)
-            end_idx = start_idx + files_per_rank + 1
-        else:
-            start_idx = rank * files_per_rank + remainder
-            end_idx = start_idx + files_per_rank
-
-        assigned_files = file_list[start_idx:end_idx]
-        print(f"Rank {rank}: Assigned {len(assigned_files)} files.", flush=True)
-
-        # Process assigned files and generate PNGs
-        for file in assigned_files:
-            df = process_file(file)
-            if df is not None:
-                # Load the locations file for merging
-                locations_df = pd.read_csv('input_csv/locations.csv')
-
-                # Merge coordinates for start and end locations
-                df = df.merge(
-                    locations_df[['#name', 'latitude', 'longitude']].rename(
-                        columns={'#name': 'start_location', 'latitude': 'start_lat', 'longitude': 'start_lon'}
-                    ),
-                    on='start_location',
-                    how='left'
+        # Phase 1: repartition the rows of every file by timestep; ranks take the largest remaining file when free
+        progress = Progress(len(file_list), "Partitioning", args.progress and rank == 0)
+        stats = schedule(
+            comm,
+            file_list,
+            lambda file: partition_file(file, partition_dir),
+            costs=file_sizes,
+            on_result=lambda position, result: progress.update()
+        )
+        if rank == 0:
+            report(stats, "Partitioning")
+            timesteps = list_timesteps(partition_dir)
+
+            # Completed PNGs are journaled, so that a resubmitted job only renders the missing ones;
+            # the journal is only reused if neither the input files nor the locations changed.
+            # A video needs every frame, so it is always rendered in full.
+            if not args.video:
+                journal = Journal(
+                    os.path.join("flee_checkpoints", "links_pngs.journal"),
+                    {
+                        'sources': {file: file_key(file) for file in file_list},
+                        'locations': file_key('input_csv/locations.csv'),
+                        'output_dir': output_dir
+                    }
                 )
+                if args.resume:
+                    num_timesteps = len(timesteps)
+                    timesteps = resume_units(journal, timesteps, lambda timestep: png_path(output_dir, timestep))
+                    print(f"Rank {rank}: Resuming with {len(timesteps)} of {num_timesteps} timesteps to render", flush=True)
+                else:
+                    journal.start()
+            timestep_sizes = [timestep_bytes(partition_dir, timestep) for timestep in timesteps]
+        else:
+            timesteps = None
+            timestep_sizes = None
+
+        timesteps = comm.bcast(timesteps, root=0)
+        timestep_sizes = comm.bcast(timestep_sizes, root=0)
 
-                df = df.merge(
-                    locations_df[['#name', 'latitude', 'longitude']].rename(
-                        columns={'#name': 'end_location', 'latitude': 'end_lat', 'longitude': 'end_lon'}
-                    ),
-                    on='end_location',
-                    how='left'
+        # Phase 2: render each timestep once from the merged partitions
+        progress = Progress(len(timesteps), "Rendering", args.progress and rank == 0)
+        if args.video:
+            png_dir = None if args.no_pngs else output_dir
+            render = lambda timestep: render_partition(timestep, partition_dir, png_dir)
+            max_pending = args.max_pending or 2 * size
+
+            # Frames are rendered large enough for the largest output profile and downscaled for the others
+            profiles = [OutputProfile.parse(spec, args.fps) for spec in args.profile or []] or [OutputProfile(fps=args.fps)]
+            get_renderer('links', dpi=dpi_for_sizes([profile.size for profile in profiles]))
+            if args.segmented:
+                # Ranks render and encode consecutive segments of the timeline with their own encoders;
+                # rank 0 joins the segments without re-encoding
+                stats, video_paths = mpi_render_segmented(
+                    comm, render, timesteps, profiles, args.video,
+                    args.segment_frames or segment_length(len(timesteps), max(1, size - 1)),
+                    on_result=lambda result: progress.update()
                 )
+                for path in video_paths:
+                    print(f"Rank {rank}: Video created: {path}", flush=True)
+            elif rank == 0:
+                # Ranks render timesteps as they become free; rank 0 reassembles the frames by timestep
+                # and pipes them to a single encoder, holding at most max_pending frames at a time
+                writer, video_paths = open_profiles(profiles, args.video)
+                with writer:
+                    stats = mpi_render_ordered(
+                        comm, render, timesteps, writer, max_pending, on_result=lambda result: progress.update()
+                    )
+                for path in video_paths:
+                    print(f"Rank {rank}: Video created: {path}", flush=True)
+            else:
+                stats = mpi_render_ordered(comm, render, timesteps, None, max_pending)
+        else:
+            # Ranks render timesteps as they become free, largest first; only whether the PNG
+            # was written is sent back to rank 0, not the frame
+            render = lambda timestep: render_partition(timestep, partition_dir, output_dir)[1] is not None
 
-                # Sort data by time
-                df = df.sort_values(by=['#time'])
+            def record_timestep(position, written):
+                progress.update()
+                if written:
+                    journal.record(timesteps[position])
 
-                # Generate PNGs for each timestep in this file
-                for timestep in sorted(df['#time'].unique()):
-                    plot_timestep(timestep, df, output_dir)
-                    print(f"Rank {rank}: Generated PNG for timestep {timestep} from file {file}", flush=True)
+            stats = schedule(comm, timesteps, render, costs=timestep_sizes, on_result=record_timestep)
+        if rank == 0:
+            if not args.video:
+                journal.close()
+            report(stats, "Rendering")
+
+        # Gather the per-stage timings of all ranks into one summary
+        report_mpi(comm, args.summary, start_time)
 
         comm.Barrier()
         if rank == 0:
-            print("All ranks completed PNG generation successfully.", flush=True)
+            print("All ranks completed rendering successfully.", flush=True)
     except Exception as e:
         print(f"Rank {rank}: Error occurred: {traceback.format_exc()}", flush=True)
-
-
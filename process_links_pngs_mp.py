@@ -1,14 +1,25 @@
+import numpy as np
 import pandas as pd
 import glob
 import os
+import argparse
+import time
 import traceback
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Pool
 
 # os.environ["MPLCONFIGDIR"] = "/work/e723/e723/mzr123/matplotlib_config"
 
 import matplotlib.pyplot as plt
 from matplotlib import colors
-from mpl_toolkits.basemap import Basemap
+
+from renderer import get_renderer
+from locations import LocationIndex, get_location_index
+from aggregate import sum_edges
+from partition import (
+    write_partitions, file_key, is_cached, mark_cached, drop_source, prune_sources, list_timesteps, load_timestep
+)
+from instrumentation import Progress, start_workers, report_workers, starmap_progress, stage, add
+from workers import init_worker, worker_count, BASE_WORKER_MEMORY, RENDERER_MEMORY
 
 
 def process_file(file):
@@ -16,7 +27,9 @@ def process_file(file):
     Process a single file and return a DataFrame.
     """
     try:
-        df = pd.read_csv(file, index_col=False)
+        with stage('read', nbytes=os.path.getsize(file)):
+            df = pd.read_csv(file, index_col=False)
+        add('read', rows=len(df))
         df.index.name = 'Index'
         
         # Drop rows with NaN values
@@ -36,10 +49,9 @@ def plot_timestep(timestep, links_data, output_dir):
     Generate a PNG for a given timestep.
     """
     try:
-        plt.figure(figsize=(12, 8))
-        m = Basemap(projection='merc', llcrnrlat=4, urcrnrlat=14, llcrnrlon=2, urcrnrlon=15, resolution='i')
-        m.drawcountries()
-        m.drawcoastlines()
+        # Reuse the projection and background of this process
+        renderer = get_renderer('links')
+        index = get_location_index()
 
         # Filter data for this timestep
         timestep_data = links_data[links_data['#time'] == timestep]
@@ -48,70 +60,93 @@ def plot_timestep(timestep, links_data, output_dir):
         cmap = plt.colormaps['coolwarm']
         norm = colors.Normalize(vmin=0, vmax=1000)
 
-        # Plot connections between locations
-        for _, row in timestep_data.iterrows():
-            norm_value = norm(min(row['cum_num_agents'], 1000))  # Cap value at 1000
-            link_color = cmap(norm_value)
-            capped_value = min(row['cum_num_agents'], 1000)
-            linewidth = min(0.5 + 0.005 * capped_value, 3.0)
-
-            m.plot(
-                [row['start_lon'], row['end_lon']],
-                [row['start_lat'], row['end_lat']],
-                latlon=True,
-                color=link_color,
-                alpha=0.4,
-                linewidth=linewidth
-            )
+        # Sum the partial counts of each link over all rank files, so every link is drawn once
+        start_ids, end_ids, link_counts = sum_edges(
+            timestep_data['start_id'].values, timestep_data['end_id'].values, timestep_data['cum_num_agents'].values, len(index)
+        )
+
+        # Colors and widths for all links at once
+        capped_values = np.minimum(link_counts, 1000)  # Cap values at 1000
+        link_colors = cmap(norm(capped_values))
+        linewidths = np.minimum(0.5 + 0.005 * capped_values, 3.0)
+
+        # Projected start and end points of all links
+        start_x, start_y = index.project(renderer, start_ids)
+        end_x, end_y = index.project(renderer, end_ids)
+
+        # Plot connections between locations as a single collection
+        renderer.lines(
+            start_x,
+            start_y,
+            end_x,
+            end_y,
+            colors=link_colors,
+            alpha=0.4,
+            linewidths=linewidths
+        )
 
         output_path = os.path.join(output_dir, f"links_timestep_{timestep:03d}.png")
-        plt.savefig(output_path)
-        plt.close()
+        renderer.save(renderer.render(), output_path)
         return output_path
     except Exception as e:
         print(f"Error in plot_timestep for timestep {timestep}: {traceback.format_exc()}", flush=True)
         raise
 
 
-def process_and_plot(file):
+def partition_file(file, partition_dir):
     """
-    Process a file and generate PNGs for all timesteps in it.
+    Process a file and split its rows into per-timestep partitions.
     """
     try:
+        # Reuse the cached partitions if neither the file nor the locations changed
+        params = {'locations': file_key('input_csv/locations.csv')}
+        if is_cached(file, partition_dir, params):
+            return
+        drop_source(file, partition_dir)
+
         df = process_file(file)
         if df is not None:
-            # Load the locations file for merging
-            locations_df = pd.read_csv('input_csv/locations.csv')
-
-            # Merge coordinates for start and end locations
-            df = df.merge(
-                locations_df[['#name', 'latitude', 'longitude']].rename(
-                    columns={'#name': 'start_location', 'latitude': 'start_lat', 'longitude': 'start_lon'}
-                ),
-                on='start_location',
-                how='left'
-            )
-
-            df = df.merge(
-                locations_df[['#name', 'latitude', 'longitude']].rename(
-                    columns={'#name': 'end_location', 'latitude': 'end_lat', 'longitude': 'end_lon'}
-                ),
-                on='end_location',
-                how='left'
-            )
-
-            # Sort data by time
-            df = df.sort_values(by=['#time'])
-
-            # Generate PNGs for each timestep in this file
-            for timestep in sorted(df['#time'].unique()):
-                plot_timestep(timestep, df, output_dir)
-                print(f"Generated PNG for timestep {timestep} from file {file}", flush=True)
+            # Look up the location ids of the start and end locations
+            index = get_location_index()
+            df['start_id'] = index.lookup(df['start_location'])
+            df['end_id'] = index.lookup(df['end_location'])
+            df = df[['#time', 'start_id', 'end_id', 'cum_num_agents']]
+
+            # Repartition the rows of this file by timestep
+            write_partitions(df, file, partition_dir)
+            mark_cached(file, partition_dir, params)
     except Exception as e:
         print(f"Error processing file {file}: {traceback.format_exc()}", flush=True)
 
 
+def plot_partition(timestep, partition_dir, output_dir):
+    """
+    Generate the PNG for a timestep from the rows of all files.
+    """
+    try:
+        df = load_timestep(partition_dir, timestep)
+        if df is not None:
+            plot_timestep(timestep, df, output_dir)
+    except Exception as e:
+        print(f"Error plotting timestep {timestep}: {traceback.format_exc()}", flush=True)
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render links PNGs from Flee links.out.* files.")
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        help="Show a progress meter of each phase."
+    )
+    parser.add_argument(
+        "--summary",
+        type=str,
+        default="links_run_summary.json",
+        help="Path of the JSON summary of the per-stage timings of all workers."
+    )
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
     try:
         # Create output directory for PNGs
         output_dir = "./output_links_pngs"
@@ -120,22 +155,49 @@ if __name__ == "__main__":
         # Gather all log files
         file_list = sorted(glob.glob('links.out.*'), key=lambda x: int(x.split('.')[-1]))
 
-        # Use multiprocessing to parallelize file processing
-        num_workers = min(cpu_count(), len(file_list))  # Use available CPUs or the number of files, whichever is smaller
-        
+        # Partitions of earlier runs are reused, except for files that no longer exist
+        partition_dir = os.path.join("flee_partitions", "links")
+        prune_sources(file_list, partition_dir)
+
+        # Build the location index once and share it with every worker
+        location_index = LocationIndex.from_csv('input_csv/locations.csv')
+
+        # One pool serves both phases; each worker holds a whole links file (about twice its size
+        # once parsed) and a warm renderer
+        largest_file = max((os.path.getsize(file) for file in file_list), default=0)
+        num_workers = worker_count(BASE_WORKER_MEMORY + RENDERER_MEMORY + 2 * largest_file)
+
         print(f"Found {len(file_list)} files and {num_workers} workers to process.")
-        
-        with Pool(processes=num_workers) as pool:
+
+        # Workers started from now on report their per-stage timings when they exit
+        stats_dir = start_workers()
+
+        with Pool(processes=num_workers, initializer=init_worker, initargs=(location_index, {'links': {}})) as pool:
             try:
-                # Map the processing function across files
-                pool.map(process_and_plot, file_list)
-            except Exception as e:
-                print(f"Error occurred during multiprocessing: {e}", flush=True)
+                # Phase 1: repartition the rows of every file by timestep
+                try:
+                    progress = Progress(len(file_list), "Partitioning", args.progress)
+                    starmap_progress(pool, partition_file, [(file, partition_dir) for file in file_list], progress)
+                except Exception as e:
+                    print(f"Error occurred during multiprocessing: {e}", flush=True)
+
+                # Phase 2: render each timestep once from the merged partitions, on the same warm workers
+                timesteps = list_timesteps(partition_dir)
+                print(f"Found {len(timesteps)} timesteps and {num_workers} workers to render.")
+
+                try:
+                    progress = Progress(len(timesteps), "Rendering", args.progress)
+                    starmap_progress(pool, plot_partition, [(timestep, partition_dir, output_dir) for timestep in timesteps], progress)
+                except Exception as e:
+                    print(f"Error occurred during multiprocessing: {e}", flush=True)
             finally:
                 # Ensure the pool is closed and joined properly
                 pool.close()
                 pool.join()
 
+        # Summarize the per-stage timings of this process and all workers
+        report_workers(stats_dir, args.summary, start_time)
+
         print("All files processed and PNGs generated successfully.")
     except Exception as e:
         print(f"Error occurred: {traceback.format_exc()}")
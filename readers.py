@@ -0,0 +1,198 @@
+import io
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import stage, add
+
+# Columns of agents.out.* needed for rendering, and their compact dtypes
+AGENTS_COLUMNS = ['#time', 'original_location', 'gps_x', 'gps_y', 'current_location']
+AGENTS_DTYPES = {
+    '#time': 'int16',
+    'original_location': 'category',
+    'gps_x': 'float32',
+    'gps_y': 'float32',
+    'current_location': 'category',
+}
+
+# Prefix of location names of agents travelling on a link
+LOCATION_PREFIX = r'L:.*?:'
+
+# Default memory budget of a streaming reader, in bytes
+DEFAULT_MEMORY_BUDGET = 256 * 1024 ** 2
+
+# Rough ratio between the memory a parsed chunk needs and its size on disk
+PARSE_OVERHEAD = 4
+
+# Smallest byte range a rank file is split into for parallel parsing
+MIN_RANGE_BYTES = 16 * 1024 ** 2
+
+
+def chunk_rows(file, memory_budget=DEFAULT_MEMORY_BUDGET, sample_bytes=64 * 1024):
+    """
+    Function to estimate how many rows of a CSV file fit into the memory budget.
+    The average line length is measured on the first `sample_bytes` of the file.
+    """
+    with open(file, 'rb') as f:
+        sample = f.read(sample_bytes)
+    num_lines = max(sample.count(b'\n'), 1)
+    line_bytes = max(len(sample) // num_lines, 1)
+    return max(memory_budget // (line_bytes * PARSE_OVERHEAD), 1000)
+
+
+class ByteRange(io.RawIOBase):
+    """
+    Read-only stream over the header line of a CSV file followed by one byte range of its rows,
+    so that each range parses like a complete file.
+    """
+
+    def __init__(self, file, start, end):
+        self._file = open(file, 'rb')
+        self._header = self._file.readline()
+        self._file.seek(start)
+        self._remaining = max(end - start, 0)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._header:
+            n = min(len(buffer), len(self._header))
+            buffer[:n] = self._header[:n]
+            self._header = self._header[n:]
+            return n
+        data = self._file.read(min(len(buffer), self._remaining))
+        buffer[:len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def split_byte_ranges(file, num_ranges):
+    """
+    Function to split the rows of a CSV file into at most `num_ranges` newline-aligned (start, end) byte ranges.
+    The first range starts after the header line.
+    """
+    size = os.path.getsize(file)
+    with open(file, 'rb') as f:
+        f.readline()
+        data_start = f.tell()
+        bounds = [data_start]
+        for k in range(1, num_ranges):
+            target = data_start + (size - data_start) * k // num_ranges
+            if target <= bounds[-1]:
+                continue
+            # Move the boundary to the start of the next line
+            f.seek(target - 1)
+            f.readline()
+            if f.tell() >= size:
+                break
+            if f.tell() > bounds[-1]:
+                bounds.append(f.tell())
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def first_timestep(file, start=0):
+    """
+    Function to read the timestep of the first row at byte offset `start` of a rank file, without parsing the rest.
+    Offset 0 stands for the first row after the header. Returns None if there is no such row.
+    """
+    try:
+        with open(file, 'rb') as f:
+            if start == 0:
+                f.readline()
+            else:
+                f.seek(start)
+            return int(f.readline().split(b',', 1)[0])
+    except (OSError, ValueError):
+        return None
+
+
+def plan_byte_ranges(file_list, num_units, min_range_bytes=MIN_RANGE_BYTES):
+    """
+    Function to split rank files into about `num_units` work units of similar size.
+    Large files are split into several byte ranges, so parallelism does not depend on the number of files.
+    Returns a list of (file, start, end, range_index) tuples.
+    """
+    sizes = [os.path.getsize(file) for file in file_list]
+    target = max(sum(sizes) // max(num_units, 1), min_range_bytes)
+
+    units = []
+    for file, size in zip(file_list, sizes):
+        ranges = split_byte_ranges(file, max(math.ceil(size / target), 1))
+        units.extend((file, start, end, range_index) for range_index, (start, end) in enumerate(ranges))
+    return units
+
+
+def iter_agents_batches(file, memory_budget=DEFAULT_MEMORY_BUDGET, byte_range=None, selection=None):
+    """
+    Function to stream an agents.out.* file as (timestep, DataFrame) batches.
+    Only the essential columns are parsed, with compact dtypes, and at most one chunk
+    sized by the memory budget is held at a time. A timestep spanning several chunks
+    is yielded as several batches. With a (start, end) `byte_range`, only the rows in
+    that range of the file are read. With a `selection`, rows outside its time window and
+    bounding box are dropped as soon as a chunk is parsed, and reading stops after the window.
+    """
+    if os.path.getsize(file) == 0:
+        raise pd.errors.EmptyDataError(f"No columns to parse from file {file}")
+
+    source = io.BufferedReader(ByteRange(file, *byte_range)) if byte_range is not None else file
+    reader = pd.read_csv(
+        source,
+        index_col=False,
+        usecols=AGENTS_COLUMNS,
+        dtype=AGENTS_DTYPES,
+        chunksize=chunk_rows(file, memory_budget)
+    )
+    add('read', nbytes=byte_range[1] - byte_range[0] if byte_range is not None else os.path.getsize(file))
+    try:
+        with reader:
+            while True:
+                # Only the parsing is timed, not the consumer of the batches
+                with stage('read'):
+                    chunk = next(reader, None)
+                    if chunk is None or (selection is not None and selection.past_window(chunk)):
+                        break
+                    if selection is not None:
+                        chunk = selection.filter_agents(chunk)
+                    # Drop rows with NaN values
+                    chunk = chunk.dropna()
+                add('read', rows=len(chunk))
+                for timestep, batch in chunk.groupby('#time', sort=True, observed=True):
+                    yield int(timestep), batch
+    finally:
+        if byte_range is not None:
+            source.close()
+
+
+def clean_locations(locations):
+    """
+    Function to strip the `L:...:` prefix from a Series of location strings.
+    The regex runs once per unique value and the result is mapped back through the categorical codes.
+    Returns the cleaned categorical Series and the number of invalid (missing or non-string) values.
+    """
+    values = locations.astype('category')
+    categories = values.cat.categories
+    codes = values.cat.codes.to_numpy()
+
+    if len(categories) == 0:
+        cleaned_codes, cleaned_categories = codes, pd.Index([], dtype=object)
+    else:
+        # Clean each unique value once; non-string values become missing
+        is_valid = np.fromiter((isinstance(c, str) for c in categories), dtype=bool, count=len(categories))
+        cleaned = pd.Series(categories, dtype=object).where(is_valid).str.replace(LOCATION_PREFIX, '', regex=True)
+        category_codes, cleaned_categories = pd.factorize(cleaned)
+        cleaned_codes = np.where(codes >= 0, category_codes[codes], -1)
+
+    cleaned_locations = pd.Series(
+        pd.Categorical.from_codes(cleaned_codes, categories=cleaned_categories),
+        index=locations.index,
+        name=locations.name
+    )
+    return cleaned_locations, int((cleaned_codes < 0).sum())
@@ -0,0 +1,160 @@
+import math
+import os
+
+import numpy as np
+import matplotlib
+import matplotlib.image as mpimg
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+from mpl_toolkits.basemap import Basemap
+
+from instrumentation import stage, add
+
+# Map extent used by all frame renderers
+DEFAULT_EXTENT = {'llcrnrlat': 4, 'urcrnrlat': 14, 'llcrnrlon': 2, 'urcrnrlon': 15}
+
+# Figure size of all frame renderers, in inches
+FIGSIZE = (12, 8)
+
+# Renderers built by this process, keyed by name
+_renderers = {}
+
+
+class MapRenderer:
+    """
+    Renderer that builds the Basemap projection and the country/coastline background once,
+    and draws only the dynamic layers of each frame on top of a cached copy of the background.
+    """
+
+    def __init__(self, figsize=FIGSIZE, dpi=None, resolution='i', extent=None, legend=None):
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot(111)
+
+        # Build the projection and draw the static layers once
+        self.basemap = Basemap(projection='merc', resolution=resolution, ax=self.ax, **(extent or DEFAULT_EXTENT))
+        self.basemap.drawcountries(ax=self.ax)
+        self.basemap.drawcoastlines(ax=self.ax)
+
+        # The legend is static but animated, so it stays out of the background and is drawn over every frame
+        self._legend = None
+        if legend:
+            for entry in legend:
+                self.ax.scatter([], [], **entry)
+            self._legend = self.ax.legend(loc='lower left')
+            self._legend.set_animated(True)
+
+        self._background = None
+        self._dynamic = []
+
+    def project(self, lon, lat):
+        """
+        Project longitude/latitude arrays to map coordinates in one call.
+        """
+        return self.basemap(np.asarray(lon, dtype=float), np.asarray(lat, dtype=float))
+
+    def scatter(self, lon, lat, **kwargs):
+        """
+        Add a dynamic scatter layer to the current frame.
+        """
+        x, y = self.project(lon, lat)
+        return self.scatter_xy(x, y, **kwargs)
+
+    def scatter_xy(self, x, y, **kwargs):
+        """
+        Add a dynamic scatter layer of already projected points to the current frame.
+        """
+        with stage('render', rows=len(x)):
+            artist = self.ax.scatter(x, y, animated=True, **kwargs)
+        self._dynamic.append(artist)
+        return artist
+
+    def lines(self, start_x, start_y, end_x, end_y, **kwargs):
+        """
+        Add a dynamic layer of straight segments between projected points to the current frame
+        as a single LineCollection.
+        """
+        # Segments array of shape (num_segments, 2 points, 2 coordinates)
+        segments = np.empty((len(start_x), 2, 2))
+        segments[:, 0, 0] = start_x
+        segments[:, 0, 1] = start_y
+        segments[:, 1, 0] = end_x
+        segments[:, 1, 1] = end_y
+
+        with stage('render', rows=len(segments)):
+            collection = LineCollection(segments, animated=True, **kwargs)
+            self.ax.add_collection(collection, autolim=False)
+        self._dynamic.append(collection)
+        return collection
+
+    def prepare(self):
+        """
+        Draw the static layers once and cache them as the background of every frame.
+        """
+        if self._background is None:
+            with stage('setup'):
+                self.canvas.draw()
+                self._background = self.canvas.copy_from_bbox(self.figure.bbox)
+
+    def render(self):
+        """
+        Draw the dynamic layers on top of the cached background and return the frame as an RGBA array.
+        The dynamic layers are removed afterwards, ready for the next frame.
+        """
+        self.prepare()
+        with stage('render'):
+            self.canvas.restore_region(self._background)
+            for artist in sorted(self._dynamic, key=lambda a: a.get_zorder()):
+                self.ax.draw_artist(artist)
+            if self._legend is not None:
+                self.ax.draw_artist(self._legend)
+            frame = np.asarray(self.canvas.buffer_rgba()).copy()
+
+        self.clear()
+        return frame
+
+    def clear(self):
+        """
+        Remove the dynamic layers of the current frame.
+        """
+        for artist in self._dynamic:
+            artist.remove()
+        self._dynamic = []
+
+    @staticmethod
+    def save(frame, output_path):
+        """
+        Write a rendered frame to a PNG file. The frame is written to a temporary name and renamed,
+        so a job killed while saving never leaves a truncated PNG behind. The temporary name is hidden
+        and does not end in .png, so globs over the frames of a run never pick it up.
+        """
+        directory, name = os.path.split(output_path)
+        tmp_path = os.path.join(directory, f".{name}.tmp.{os.getpid()}")
+        with stage('save'):
+            mpimg.imsave(tmp_path, frame, format='png')
+            os.replace(tmp_path, output_path)
+        add('save', nbytes=os.path.getsize(output_path))
+
+
+def dpi_for_sizes(sizes, figsize=FIGSIZE):
+    """
+    Function to return the lowest DPI at which frames cover the largest of `sizes` (width, height)
+    when fitted into it, so that every output is a downscale of the rendered frame and the largest
+    is written as rendered. A size of None stands for the default DPI. Returns None without sizes.
+    """
+    dpis = [
+        matplotlib.rcParams['figure.dpi'] if size is None else min(size[0] / figsize[0], size[1] / figsize[1])
+        for size in sizes
+    ]
+    return math.ceil(max(dpis)) if dpis else None
+
+
+def get_renderer(name, **kwargs):
+    """
+    Function to return the renderer `name` of this process, building it on first use.
+    """
+    if name not in _renderers:
+        with stage('setup'):
+            _renderers[name] = MapRenderer(**kwargs)
+    return _renderers[name]
@@ -0,0 +1,156 @@
+import queue
+import threading
+from collections import deque
+
+from scheduler import schedule
+from sharedmem import SharedArray
+
+
+class ReorderBuffer:
+    """
+    Buffer that accepts rendered frames out of order and passes them to a single writer strictly in order.
+    Frames are identified by their position in the timestep list. At most `capacity` positions beyond the
+    next frame to write may be outstanding; producers must not start a position unless `can_accept` allows it.
+    """
+
+    def __init__(self, writer, capacity):
+        self.writer = writer
+        self.capacity = max(int(capacity), 1)
+        self.next_index = 0
+        self.pending = {}
+
+    def can_accept(self, index):
+        """
+        Check whether a frame at this position may be started without exceeding the capacity.
+        """
+        return index < self.next_index + self.capacity
+
+    def push(self, index, frame):
+        """
+        Accept the frame of a position and write every frame that is now in order.
+        A missing frame (None) is skipped when its turn comes. Frames in shared memory
+        are written straight from the shared block, which is freed afterwards.
+        """
+        self.pending[index] = frame
+        while self.next_index in self.pending:
+            frame = self.pending.pop(self.next_index)
+            if isinstance(frame, SharedArray):
+                # No view of the block may outlive the write, or it cannot be freed
+                try:
+                    self.writer.write(frame.attach())
+                finally:
+                    frame.release()
+            elif frame is not None:
+                self.writer.write(frame)
+            self.next_index += 1
+
+    def discard(self):
+        """
+        Free the shared memory of frames that will not be written, e.g. after an error.
+        """
+        for frame in self.pending.values():
+            if isinstance(frame, SharedArray):
+                frame.release()
+        self.pending = {}
+
+
+def render_shared(render, item):
+    """
+    Function to run `render(item)` in a pool worker and move the frame of its result into shared memory,
+    so that only the name of the block is pickled back to the writer process.
+    """
+    result = render(item)
+    if result is not None and result[1] is not None:
+        result = (result[0], SharedArray.from_array(result[1])) + tuple(result[2:])
+    return result
+
+
+def feed_items(items, events):
+    """
+    Function to pass the items of an iterator to `render_ordered` as they become available, from a separate thread.
+    """
+    count = 0
+    try:
+        for item in items:
+            events.put(('item', None, item))
+            count += 1
+        events.put(('end', count, None))
+    except Exception as e:
+        events.put(('error', None, e))
+
+
+def render_ordered(pool, render, items, writer, capacity, on_result=None):
+    """
+    Function to render items on a multiprocessing pool and write the frames in order.
+    `render(item)` must return a tuple starting with (item, frame). Renderers never get more than `capacity`
+    items ahead of the writer, which bounds the memory held by finished but unwritten frames.
+    `items` may also be an iterator that blocks until the next item is ready, e.g. timesteps released while
+    the files are still being partitioned; rendering starts with the first item.
+    Every result is also passed to `on_result(result)` in this process, with None for failed items.
+    Frames return through shared memory; `render` must be picklable, e.g. a `functools.partial` of a module function.
+    """
+    buffer = ReorderBuffer(writer, capacity)
+    events = queue.Queue()
+    if isinstance(items, (list, tuple)):
+        ready = deque(items)
+        total = len(items)
+    else:
+        ready = deque()
+        total = None
+        threading.Thread(target=feed_items, args=(items, events), daemon=True).start()
+    next_submit = 0
+    received = 0
+
+    try:
+        while total is None or buffer.next_index < total:
+            # Submit work only while it fits in the reorder window
+            while ready and buffer.can_accept(next_submit):
+                pool.apply_async(
+                    render_shared,
+                    (render, ready.popleft()),
+                    callback=lambda result, index=next_submit: events.put(('frame', index, result)),
+                    error_callback=lambda error, index=next_submit: events.put(('frame', index, None))
+                )
+                next_submit += 1
+
+            kind, index, result = events.get()
+            if kind == 'item':
+                ready.append(result)
+                continue
+            if kind == 'end':
+                total = index
+                continue
+            if kind == 'error':
+                raise result
+            received += 1
+            if on_result is not None:
+                on_result(result)
+            buffer.push(index, result[1] if result is not None else None)
+    finally:
+        # After an error, wait for the frames still being rendered and free their shared memory
+        buffer.discard()
+        while received < next_submit:
+            kind, index, result = events.get()
+            if kind != 'frame':
+                continue
+            received += 1
+            if result is not None and isinstance(result[1], SharedArray):
+                result[1].release()
+
+
+def mpi_render_ordered(comm, render, items, writer, capacity, on_result=None):
+    """
+    Function to render items on all MPI ranks and write the frames in order on rank 0.
+    Rank 0 hands out items to the other ranks, at most `capacity` positions ahead of the writer,
+    and feeds the returned frames to `writer` through a ReorderBuffer. `render(item)` must return
+    an (item, frame) pair; rank 0 calls `on_result(result)` with every result, e.g. to track progress.
+    Returns the per-rank statistics of the scheduler on rank 0.
+    """
+    buffer = ReorderBuffer(writer, capacity) if comm.Get_rank() == 0 else None
+
+    def push_result(index, result):
+        if on_result is not None:
+            on_result(result)
+        buffer.push(index, result[1] if result is not None else None)
+
+    return schedule(comm, items, render, on_result=push_result, can_dispatch=buffer.can_accept if buffer else None)
@@ -0,0 +1,105 @@
+import json
+import os
+
+import numpy as np
+
+from aggregate import count_cells, sum_edges, CELL_DEGREES
+from locations import get_location_index
+from partition import load_timestep, timestep_key
+
+# Version of the statistics file layout
+STATS_VERSION = 1
+
+# Log-spaced histogram bins shared by all summaries: 0, then 1 to 10^9 agents in steps of 10^(1/16)
+BIN_EDGES = np.concatenate([[0.0], np.logspace(0, 9, 9 * 16 + 1)])
+
+# Quantile of the per-marker and per-link counts mapped to the top of the color and size scales
+SCALE_QUANTILE = 0.99
+
+
+def histogram(values):
+    """
+    Function to summarize values as counts in the shared log-spaced bins, so that the summaries
+    of all timesteps can be added up and queried for quantiles.
+    """
+    counts, _ = np.histogram(np.clip(np.asarray(values, dtype=float), 0, BIN_EDGES[-1]), bins=BIN_EDGES)
+    return counts
+
+
+def quantile(counts, q=SCALE_QUANTILE):
+    """
+    Function to return the upper bin edge at quantile q of a histogram, or None if it is empty.
+    """
+    counts = np.asarray(counts)
+    total = counts.sum()
+    if total == 0:
+        return None
+    position = np.searchsorted(np.cumsum(counts), q * total)
+    return float(BIN_EDGES[min(position + 1, len(BIN_EDGES) - 1)])
+
+
+def summarize_timestep(kind, partition_dir, timestep):
+    """
+    Function to summarize the values drawn in the frame of one timestep: the agents per grid cell,
+    or the summed agents per link. Only the columns needed are read from the partitions.
+    Returns (timestep, histogram as a list).
+    """
+    if kind == 'agents':
+        df = load_timestep(partition_dir, timestep, columns=['gps_x', 'gps_y'])
+        values = count_cells(df['gps_y'].values, df['gps_x'].values, CELL_DEGREES)[2] if df is not None else []
+    else:
+        df = load_timestep(partition_dir, timestep, columns=['start_id', 'end_id', 'cum_num_agents'])
+        values = []
+        if df is not None:
+            values = sum_edges(
+                df['start_id'].values, df['end_id'].values, df['cum_num_agents'].values, len(get_location_index())
+            )[2]
+    return timestep, histogram(values).tolist()
+
+
+def compute_scale(kind, partition_dir, timesteps, pool=None):
+    """
+    Function to compute the global scale of a layer: the SCALE_QUANTILE quantile of its values over all timesteps.
+    The per-timestep summaries are cached in `stats.json` next to the partitions and reused as long as the
+    part files of a timestep are unchanged, so only new or repartitioned timesteps are read.
+    Returns None if there are no values.
+    """
+    stats_path = os.path.join(partition_dir, 'stats.json')
+    cached = {}
+    try:
+        with open(stats_path) as f:
+            stats = json.load(f)
+        if stats.get('version') == STATS_VERSION and stats.get('bins') == len(BIN_EDGES):
+            cached = stats['timesteps']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    keys = {timestep: timestep_key(partition_dir, timestep) for timestep in timesteps}
+    summaries = {}
+    pending = []
+    for timestep in timesteps:
+        entry = cached.get(str(timestep))
+        if entry is not None and entry['key'] == keys[timestep]:
+            summaries[timestep] = entry['histogram']
+        else:
+            pending.append(timestep)
+
+    # Summarize the missing timesteps, in parallel if a pool is given
+    tasks = [(kind, partition_dir, timestep) for timestep in pending]
+    results = pool.starmap(summarize_timestep, tasks) if pool is not None else [summarize_timestep(*task) for task in tasks]
+    summaries.update(results)
+
+    if pending:
+        tmp_path = f"{stats_path}.tmp.{os.getpid()}"
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'version': STATS_VERSION,
+                'bins': len(BIN_EDGES),
+                'timesteps': {
+                    str(timestep): {'key': keys[timestep], 'histogram': summaries[timestep]} for timestep in timesteps
+                }
+            }, f)
+        os.replace(tmp_path, stats_path)
+
+    total = np.sum([summaries[timestep] for timestep in timesteps], axis=0) if timesteps else []
+    return quantile(total)
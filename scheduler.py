@@ -0,0 +1,118 @@
+import traceback
+
+# MPI message tags of the master/worker protocol
+TAG_READY = 1
+TAG_WORK = 2
+TAG_STOP = 3
+
+
+def run_task(task, item, rank):
+    """
+    Function to run one work unit, reporting errors instead of letting them stop the worker.
+    """
+    try:
+        return task(item)
+    except Exception as e:
+        print(f"Rank {rank}: Error in work unit {item}: {traceback.format_exc()}", flush=True)
+        return None
+
+
+def schedule(comm, items, task, costs=None, on_result=None, can_dispatch=None):
+    """
+    Function to run `task(item)` for every item with dynamic master/worker load balancing over MPI.
+    Rank 0 hands out one unit at a time to whichever rank asks for work, so ranks that finish small
+    units early pick up more instead of waiting at a barrier. `items` must be the same on all ranks.
+    With `costs` (e.g. bytes per unit) the largest units are handed out first. On rank 0, every result
+    is passed to `on_result(position, result)`; `can_dispatch(position)` may hold back units, e.g. to
+    bound a reorder buffer. Returns the per-rank statistics on rank 0 and None on the other ranks.
+    """
+    from mpi4py import MPI
+
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    status = MPI.Status()
+    costs = list(costs) if costs is not None else [1] * len(items)
+
+    # Largest units first, so that the last units to finish are short ones
+    if any(cost != costs[0] for cost in costs):
+        order = sorted(range(len(items)), key=lambda i: costs[i], reverse=True)
+    else:
+        order = list(range(len(items)))
+
+    stats = {'rank': rank, 'units': 0, 'cost': 0, 'busy': 0.0}
+    start_time = MPI.Wtime()
+
+    if size == 1:
+        for position in order:
+            task_start = MPI.Wtime()
+            result = run_task(task, items[position], rank)
+            if on_result is not None:
+                on_result(position, result)
+            stats['busy'] += MPI.Wtime() - task_start
+            stats['units'] += 1
+            stats['cost'] += costs[position]
+    elif rank != 0:
+        # Worker: ask for work and return the result of the previous unit with the next request
+        message = None
+        while True:
+            comm.send(message, dest=0, tag=TAG_READY)
+            position = comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
+            if status.Get_tag() == TAG_STOP:
+                break
+            task_start = MPI.Wtime()
+            message = (position, run_task(task, items[position], rank))
+            stats['busy'] += MPI.Wtime() - task_start
+            stats['units'] += 1
+            stats['cost'] += costs[position]
+    else:
+        # Master: hand out units to idle workers and collect their results
+        next_unit = 0
+        idle_workers = []
+        active_workers = size - 1
+
+        while active_workers > 0:
+            message = comm.recv(source=MPI.ANY_SOURCE, tag=TAG_READY, status=status)
+            idle_workers.append(status.Get_source())
+            if message is not None and on_result is not None:
+                task_start = MPI.Wtime()
+                on_result(*message)
+                stats['busy'] += MPI.Wtime() - task_start
+
+            while idle_workers and next_unit < len(order):
+                if can_dispatch is not None and not can_dispatch(order[next_unit]):
+                    break
+                comm.send(order[next_unit], dest=idle_workers.pop(), tag=TAG_WORK)
+                next_unit += 1
+
+            # Once every unit is handed out, release the idle workers
+            if next_unit >= len(order):
+                while idle_workers:
+                    comm.send(None, dest=idle_workers.pop(), tag=TAG_STOP)
+                    active_workers -= 1
+
+    # Idle time includes waiting for work and for the slowest rank to finish
+    comm.Barrier()
+    stats['idle'] = MPI.Wtime() - start_time - stats['busy']
+    return comm.gather(stats, root=0)
+
+
+def report(stats, label):
+    """
+    Function to print the per-rank busy and idle time of a scheduled phase.
+    """
+    if not stats:
+        return
+    print(f"{label}: per-rank load", flush=True)
+    print(f"{'rank':>6} {'units':>7} {'cost':>14} {'busy [s]':>10} {'idle [s]':>10}", flush=True)
+    for entry in stats:
+        print(
+            f"{entry['rank']:>6} {entry['units']:>7} {entry['cost']:>14} {entry['busy']:>10.2f} {entry['idle']:>10.2f}",
+            flush=True
+        )
+
+    # Rank 0 only dispatches work when there are other ranks
+    workers = stats[1:] if len(stats) > 1 else stats
+    total_busy = sum(entry['busy'] for entry in workers)
+    total_idle = sum(entry['idle'] for entry in workers)
+    if total_busy + total_idle > 0:
+        print(f"{label}: workers busy {100 * total_busy / (total_busy + total_idle):.1f}% of the time", flush=True)
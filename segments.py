@@ -0,0 +1,216 @@
+import math
+import os
+import shutil
+import subprocess
+import traceback
+from multiprocessing import Pool
+
+from encoder import MultiWriter, ffmpeg_executable, encode_pngs
+from instrumentation import stage
+from workers import worker_count, BASE_WORKER_MEMORY
+
+# Keyframe interval of segmented videos; segments are whole GOPs, so the joined video
+# has the same keyframe layout as a single encoding with this interval
+GOP_FRAMES = 50
+
+# Segments per worker, so that workers finishing early pick up more of the timeline
+SEGMENTS_PER_WORKER = 4
+
+
+def segment_length(num_frames, num_workers, gop=GOP_FRAMES):
+    """
+    Function to choose the number of frames per segment: a whole number of GOPs, small enough
+    to give every worker several segments of the timeline.
+    """
+    target = math.ceil(num_frames / max(1, num_workers * SEGMENTS_PER_WORKER))
+    return max(1, math.ceil(target / gop)) * gop
+
+
+def split_segments(items, segment_frames):
+    """
+    Function to split a sequence of frames (e.g. timesteps) into consecutive segments of `segment_frames`.
+    Returns a list of (segment index, items of the segment).
+    """
+    return [
+        (index, list(items[start:start + segment_frames]))
+        for index, start in enumerate(range(0, len(items), segment_frames))
+    ]
+
+
+def segment_path(video_path, index):
+    """
+    Function to return the path of a segment of a video, in a directory next to the video.
+    """
+    root, ext = os.path.splitext(video_path)
+    return os.path.join(f"{video_path}.segments", f"segment_{index:05d}{ext or '.mp4'}")
+
+
+def clear_segments(video_path):
+    """
+    Function to delete the segments of a video left behind by an earlier run that did not finish,
+    so that they can never be joined into the video of this run.
+    """
+    shutil.rmtree(f"{video_path}.segments", ignore_errors=True)
+
+
+def concat_segments(segment_paths, video_path):
+    """
+    Function to join encoded segments into one video with ffmpeg's concat demuxer, copying the
+    compressed streams instead of re-encoding them, and delete the segments afterwards.
+    """
+    segment_dir = os.path.dirname(segment_paths[0]) if segment_paths else None
+    list_path = f"{video_path}.concat.txt"
+    with open(list_path, 'w') as f:
+        for path in segment_paths:
+            f.write(f"file '{os.path.abspath(path)}'\n")
+    command = [
+        ffmpeg_executable(), '-y', '-loglevel', 'error',
+        '-f', 'concat', '-safe', '0', '-i', list_path,
+        '-c', 'copy', video_path
+    ]
+    with stage('concat', rows=len(segment_paths)):
+        returncode = subprocess.run(command).returncode
+    os.remove(list_path)
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with code {returncode} while joining the segments of {video_path}")
+    if segment_dir:
+        shutil.rmtree(segment_dir, ignore_errors=True)
+
+
+def join_profiles(profiles, base_path, indices):
+    """
+    Function to join the segments of every output profile written by `encode_segment` in this run,
+    given the indices of the segments that were encoded successfully. Segments without frames were
+    never written and are left out. Returns the paths of the videos.
+    """
+    video_paths = []
+    for profile in profiles:
+        video_path = profile.video_path(base_path)
+        paths = [segment_path(video_path, index) for index in sorted(indices)]
+        paths = [path for path in paths if os.path.exists(path)]
+        if not paths:
+            print(f"No frames were encoded for {video_path}", flush=True)
+            continue
+        concat_segments(paths, video_path)
+        video_paths.append(video_path)
+    return video_paths
+
+
+def encode_segment(render, segment, profiles, base_path, gop=GOP_FRAMES):
+    """
+    Function to render the frames of one segment in order and encode them into one segment file per
+    output profile, e.g. on a pool worker or an MPI rank. `segment` is an (index, items) pair and
+    `render(item)` must return a tuple starting with (item, frame). Returns the results without their
+    frames, so that only metadata such as frame hashes goes back to the caller.
+    """
+    index, items = segment
+    writers = []
+    for profile in profiles:
+        path = segment_path(profile.video_path(base_path), index)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        writers.append(profile.writer(base_path, video_path=path, gop=gop))
+
+    results = []
+    with MultiWriter(writers) as writer:
+        for item in items:
+            result = render(item)
+            if result is not None and result[1] is not None:
+                writer.write(result[1])
+                result = (result[0], None) + tuple(result[2:])
+            results.append(result)
+    return results
+
+
+def render_segmented(pool, render, items, profiles, base_path, segment_frames, on_result=None):
+    """
+    Function to render and encode a timeline on a multiprocessing pool, one segment per task, and join
+    the segments into one video per output profile. Encoding runs on all workers, overlapped with rendering.
+    Every result is also passed to `on_result(result)` in this process, with None for the items of failed segments.
+    Returns the paths of the videos.
+    """
+    segments = split_segments(items, segment_frames)
+    for profile in profiles:
+        clear_segments(profile.video_path(base_path))
+    pending = [
+        (segment, pool.apply_async(encode_segment, (render, segment, profiles, base_path)))
+        for segment in segments
+    ]
+    encoded = []
+    for (index, segment_items), async_result in pending:
+        try:
+            results = async_result.get()
+            encoded.append(index)
+        except Exception as e:
+            print(f"Error encoding segment {index}: {e}", flush=True)
+            results = [None] * len(segment_items)
+        if on_result is not None:
+            for result in results:
+                on_result(result)
+    return join_profiles(profiles, base_path, encoded)
+
+
+def mpi_render_segmented(comm, render, items, profiles, base_path, segment_frames, on_result=None):
+    """
+    Function to render and encode a timeline on all MPI ranks, one segment per work unit, and join the
+    segments into one video per output profile on rank 0. Rank 0 calls `on_result(result)` with every result.
+    Returns the per-rank statistics of the scheduler and the paths of the videos on rank 0.
+    """
+    from scheduler import schedule
+
+    segments = split_segments(items, segment_frames)
+    encoded = []
+
+    # Rank 0 hands out the segments, so no other rank writes one before the old ones are gone
+    if comm.Get_rank() == 0:
+        for profile in profiles:
+            clear_segments(profile.video_path(base_path))
+
+    def record_segment(position, results):
+        if results is not None:
+            encoded.append(segments[position][0])
+        for result in results or [None] * len(segments[position][1]):
+            if on_result is not None:
+                on_result(result)
+
+    stats = schedule(
+        comm,
+        segments,
+        lambda segment: encode_segment(render, segment, profiles, base_path),
+        on_result=record_segment
+    )
+    if comm.Get_rank() != 0:
+        return stats, []
+    return stats, join_profiles(profiles, base_path, encoded)
+
+
+def encode_png_segment(png_files, video_path, fps, codec, gop):
+    """
+    Function to encode one segment of a list of PNG files, on a pool worker.
+    """
+    try:
+        encode_pngs(png_files, video_path, fps=fps, codec=codec, gop=gop)
+    except Exception as e:
+        print(f"Error encoding {video_path}: {traceback.format_exc()}", flush=True)
+        raise
+
+
+def encode_pngs_parallel(png_files, video_path, fps=2, codec='libx264', processes=None, segment_frames=None):
+    """
+    Function to encode a sorted list of PNG files into a video in segments on a multiprocessing pool,
+    decoding and encoding every segment on its own worker, and join the segments without re-encoding.
+    """
+    if not png_files:
+        print(f"No PNG files to encode into {video_path}", flush=True)
+        return
+    processes = processes or worker_count(BASE_WORKER_MEMORY)
+    segment_frames = segment_frames or segment_length(len(png_files), processes)
+    segments = split_segments(png_files, segment_frames)
+    clear_segments(video_path)
+    os.makedirs(f"{video_path}.segments", exist_ok=True)
+    tasks = [
+        (files, segment_path(video_path, index), fps, codec, GOP_FRAMES)
+        for index, files in segments
+    ]
+    with Pool(processes=min(processes, len(tasks)) or 1) as pool:
+        pool.starmap(encode_png_segment, tasks)
+    concat_segments([task[1] for task in tasks], video_path)
@@ -0,0 +1,131 @@
+import numpy as np
+
+from renderer import DEFAULT_EXTENT
+
+
+class Selection:
+    """
+    Subset of the simulation output to process: a window of timesteps, a longitude/latitude
+    bounding box and a list of location names. Parts that are not set keep all rows.
+    The readers apply the selection right after parsing, before any cleaning or location join.
+    """
+
+    def __init__(self, time_range=None, bbox=None, location_names=None):
+        self.time_range = tuple(int(t) for t in time_range) if time_range else None
+        self.bbox = tuple(float(v) for v in bbox) if bbox else None
+        self.location_names = sorted(set(location_names)) if location_names else None
+
+        if self.time_range and self.time_range[0] > self.time_range[1]:
+            raise ValueError(f"Empty time range {self.time_range[0]}-{self.time_range[1]}")
+        if self.bbox and (self.bbox[0] >= self.bbox[2] or self.bbox[1] >= self.bbox[3]):
+            raise ValueError(f"Bounding box {self.bbox} must be given as MIN_LON MIN_LAT MAX_LON MAX_LAT")
+
+    @classmethod
+    def from_args(cls, args):
+        """
+        Build the selection from the --time-range, --bbox and --location-names command-line options.
+        """
+        return cls(args.time_range, args.bbox, args.location_names)
+
+    def __bool__(self):
+        return bool(self.time_range or self.bbox or self.location_names)
+
+    def params(self):
+        """
+        Return the selection as partition cache parameters; empty without a selection, so that
+        unfiltered runs keep reusing the partitions of earlier runs.
+        """
+        if not self:
+            return {}
+        return {'selection': {'time_range': self.time_range, 'bbox': self.bbox, 'location_names': self.location_names}}
+
+    def extent(self):
+        """
+        Return the Basemap extent of the map: the bounding box if one is set, the default extent otherwise.
+        """
+        if not self.bbox:
+            return DEFAULT_EXTENT
+        min_lon, min_lat, max_lon, max_lat = self.bbox
+        return {'llcrnrlat': min_lat, 'urcrnrlat': max_lat, 'llcrnrlon': min_lon, 'urcrnrlon': max_lon}
+
+    def past_window(self, chunk):
+        """
+        Check whether a chunk of rows lies entirely after the time window. Flee writes the rows of
+        each rank file in timestep order, so no later chunk of the file can be in the window either.
+        """
+        return self.time_range is not None and len(chunk) > 0 and chunk['#time'].min() > self.time_range[1]
+
+    def filter_agents(self, chunk):
+        """
+        Keep the agents rows within the time window and whose current position (gps_y = longitude,
+        gps_x = latitude) lies in the bounding box.
+        """
+        mask = np.ones(len(chunk), dtype=bool)
+        if self.time_range:
+            time = chunk['#time'].to_numpy()
+            mask &= (time >= self.time_range[0]) & (time <= self.time_range[1])
+        if self.bbox:
+            min_lon, min_lat, max_lon, max_lat = self.bbox
+            lon = chunk['gps_y'].to_numpy()
+            lat = chunk['gps_x'].to_numpy()
+            mask &= (lon >= min_lon) & (lon <= max_lon) & (lat >= min_lat) & (lat <= max_lat)
+        return chunk if mask.all() else chunk[mask]
+
+    def area_names(self, index):
+        """
+        Return the names of the selected locations: those inside the bounding box and in the list of names.
+        Returns None if neither is set.
+        """
+        if not self.bbox and not self.location_names:
+            return None
+        names = set(self.location_names) if self.location_names else set(index.names)
+        if self.bbox:
+            min_lon, min_lat, max_lon, max_lat = self.bbox
+            inside = (
+                (index.longitude >= min_lon) & (index.longitude <= max_lon)
+                & (index.latitude >= min_lat) & (index.latitude <= max_lat)
+            )
+            names &= set(index.names[inside])
+        return names
+
+    def filter_links(self, df, index):
+        """
+        Keep the links rows within the time window with at least one end at a selected location.
+        """
+        mask = np.ones(len(df), dtype=bool)
+        if self.time_range:
+            time = df['#time'].to_numpy()
+            mask &= (time >= self.time_range[0]) & (time <= self.time_range[1])
+        names = self.area_names(index)
+        if names is not None:
+            mask &= (df['start_location'].isin(names) | df['end_location'].isin(names)).to_numpy()
+        return df if mask.all() else df[mask]
+
+
+def add_selection_arguments(parser):
+    """
+    Function to add the --time-range, --bbox and --location-names options to an argument parser.
+    """
+    parser.add_argument(
+        "--time-range",
+        type=int,
+        nargs=2,
+        metavar=("START", "END"),
+        default=None,
+        help="Only process the timesteps from START to END, inclusive."
+    )
+    parser.add_argument(
+        "--bbox",
+        type=float,
+        nargs=4,
+        metavar=("MIN_LON", "MIN_LAT", "MAX_LON", "MAX_LAT"),
+        default=None,
+        help="Only process agents positioned and links ending inside this box; the map extent follows the box."
+    )
+    parser.add_argument(
+        "--location-names",
+        type=str,
+        nargs='+',
+        default=None,
+        help="Only process agents currently at, and links from or to, these locations."
+    )
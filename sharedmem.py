@@ -0,0 +1,55 @@
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+
+
+class SharedArray:
+    """
+    Handle of a NumPy array stored in a named shared memory block. Only the name, shape and dtype
+    are pickled, so the array itself never passes through the pipes of a pool or a queue.
+    The process that attaches to the block owns it and frees it with `release()`.
+    """
+
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self._shm = None
+
+    @classmethod
+    def from_array(cls, array):
+        """
+        Copy an array into a new shared memory block and return its handle.
+        """
+        array = np.ascontiguousarray(array)
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+
+        # The consumer frees the block, so the resource tracker of this process must not
+        # remove it when this process exits
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        shm.close()
+        return cls(shm.name, array.shape, array.dtype.str)
+
+    def attach(self):
+        """
+        Attach to the block and return the array as a view of the shared memory, without copying it.
+        """
+        if self._shm is None:
+            self._shm = shared_memory.SharedMemory(name=self.name)
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+
+    def release(self):
+        """
+        Detach from the block and free it. Views returned by `attach` must not be used afterwards.
+        """
+        if self._shm is None:
+            try:
+                self._shm = shared_memory.SharedMemory(name=self.name)
+            except FileNotFoundError:
+                return
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+
+    def __getstate__(self):
+        return {'name': self.name, 'shape': self.shape, 'dtype': self.dtype, '_shm': None}
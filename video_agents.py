@@ -1,136 +1,165 @@
 import pandas as pd
 import glob
 import os
-import re
 import argparse
+import time
 import traceback
 from multiprocessing import Pool, cpu_count
-import matplotlib.pyplot as plt
-from mpl_toolkits.basemap import Basemap
-from moviepy.editor import ImageSequenceClip
+from functools import partial
 
-def process_file(file):
+from renderer import MapRenderer, get_renderer, DEFAULT_EXTENT, dpi_for_sizes
+from encoder import OutputProfile, open_profiles
+from reorder import render_ordered
+from segments import render_segmented, segment_length
+from pipeline import Stages, TimestepFeed, report_timestep, add_pipeline_arguments
+from locations import LocationIndex, get_location_index
+from aggregate import count_locations, count_cells, marker_sizes, CELL_DEGREES
+from frames import FrameStore, render_cached
+from scales import compute_scale
+from readers import iter_agents_batches, clean_locations, plan_byte_ranges, DEFAULT_MEMORY_BUDGET
+from partition import (
+    PartitionWriter, file_key, is_cached, mark_complete, drop_source, prune_sources, list_timesteps, load_timestep
+)
+from instrumentation import Progress, start_workers, report_workers, starmap_progress, stage
+from selection import Selection, add_selection_arguments
+from workers import init_worker, worker_count, BASE_WORKER_MEMORY, RENDERER_MEMORY
+
+# Static legend entries of the agents frames
+LEGEND = [
+    {'marker': '*', 'color': 'red', 'label': 'Original Locations', 's': 90, 'alpha': 0.8},
+    {'marker': 'o', 'color': 'green', 'label': 'Current Locations', 's': 50, 'alpha': 0.2},
+]
+
+# Parameters that change the look of a frame; stored frames are re-rendered when they change
+RENDER_PARAMS = {'legend': LEGEND, 'extent': DEFAULT_EXTENT, 'cell_degrees': CELL_DEGREES, 'marker_sizes': [50, 500]}
+
+def process_file(file, memory_budget=DEFAULT_MEMORY_BUDGET, byte_range=None, selection=None):
     try:
-        df = pd.read_csv(file, index_col=False)
-        df.index.name = 'Index'
-        df = df[['#time', 'original_location', 'gps_x', 'gps_y', 'current_location']].dropna()
-        # df = df.iloc[::2, :]  # Downsample rows by factor of 2
-        return df
+        for timestep, df in iter_agents_batches(file, memory_budget, byte_range, selection):
+            yield timestep, df
     except pd.errors.EmptyDataError:
         print(f"Skipping empty file: {file}", flush=True)
-        return None
-    except Exception as e:
-        print(f"Error processing file {file}: {e}", flush=True)
-        return None
 
-def clean_location(x):
-    if isinstance(x, str):
-        return re.sub(r'L:.*?:', '', x)
-    print(f"Skipping invalid value: {x}", flush=True)
-    return None
+def draw_agents(renderer, timestep_data, scale=None):
+    """
+    Function to draw the agents layer of one timestep onto a renderer.
+    Agents are aggregated first, so one marker is drawn per occupied location or grid cell.
+    `scale` is the number of agents in a cell that gets the largest marker (see scales.py).
+    """
+    index = get_location_index()
+
+    # Plot one marker per original location of the agents
+    original_ids, _ = count_locations(timestep_data['original_id'].values, len(index))
+    original_x, original_y = index.project(renderer, original_ids)
+    renderer.scatter_xy(
+        original_x,
+        original_y,
+        marker='*',
+        color='red',
+        s=90,
+        alpha=0.8,
+        zorder=2
+    )
+
+    # Count the agents per grid cell of their current positions
+    current_lon, current_lat, current_counts = count_cells(timestep_data['gps_y'].values, timestep_data['gps_x'].values)
+
+    # Plot current locations with marker sizes scaled by the exact population, within size limits
+    renderer.scatter(
+        current_lon,
+        current_lat,
+        marker='o',
+        color='green',
+        s=marker_sizes(current_counts, min_size=50, max_size=500, scale=scale),
+        alpha=0.2,
+        zorder=1
+    )
 
-def plot_timestep(timestep, agents_data, output_dir):
+def render_timestep(timestep, agents_data, scale=None):
     try:
-        # Initialize the plot
-        plt.figure(figsize=(12, 8))
-        m = Basemap(projection='merc', llcrnrlat=4, urcrnrlat=14, llcrnrlon=2, urcrnrlon=15, resolution='i')
-        m.drawcountries()
-        m.drawcoastlines()
+        # Reuse the projection and background of this process
+        renderer = get_renderer('agents', legend=LEGEND)
 
         # Filter data for the current timestep
         timestep_data = agents_data[agents_data['#time'] == timestep]
-        
-        # Separate original and current locations
-        original_locations = timestep_data[['gps_x0', 'gps_y0']]
-        current_locations = timestep_data[['gps_x', 'gps_y', 'current_location']]
-
-        # Plot original locations
-        m.scatter(
-            original_locations['gps_x0'].values,
-            original_locations['gps_y0'].values,
-            latlon=True,
-            marker='*',
-            color='red',
-            label='Original Locations',
-            s=90,
-            alpha=0.8,
-            zorder=2
-        )
-
-        # Calculate marker sizes for current locations
-        current_location_counts = timestep_data['current_location'].value_counts()
-        marker_sizes = current_locations['current_location'].map(current_location_counts)
-
-        # Define scaling parameters
-        min_size, max_size = 50, 500  # Define size limits
-
-        # Scale marker sizes and adjust colors for high counts
-        marker_sizes_scaled = marker_sizes.clip(lower=min_size, upper=max_size)
-
-        # Plot current locations with adjusted marker sizes and zorder
-        m.scatter(
-            current_locations['gps_y'].values,
-            current_locations['gps_x'].values,
-            latlon=True,
-            marker='o',
-            color='green',
-            label='Current Locations',
-            s=marker_sizes_scaled,
-            alpha=0.2,
-            zorder=1
-        )
+        draw_agents(renderer, timestep_data, scale)
 
-        # Add legend and save the plot
-        plt.legend(loc='lower left')
-        output_path = os.path.join(output_dir, f"agents_timestep_{timestep:03d}.png")
-        plt.savefig(output_path)
-        plt.close()
-        return output_path
+        return renderer.render()
     except Exception as e:
-        print(f"Error in plot_timestep for timestep {timestep}: {traceback.format_exc()}")
+        print(f"Error in render_timestep for timestep {timestep}: {traceback.format_exc()}")
         raise
 
-def process_and_plot(file, locations_df, output_dir):
+def partition_range(file, start, end, range_index, partition_dir, memory_budget=DEFAULT_MEMORY_BUDGET, selection=None):
     try:
-        df = process_file(file)
-        if df is not None:
-            df['current_location_clean'] = df['current_location'].apply(clean_location)
-            df = df.merge(
-                locations_df[['#name', 'latitude', 'longitude']].rename(
-                    columns={'#name': 'original_location', 'latitude': 'gps_y0', 'longitude': 'gps_x0'}
-                ),
-                on='original_location',
-                how='left'
-            )
-            for timestep in sorted(df['#time'].unique()):
-                plot_timestep(timestep, df, output_dir)
-                print(f"Generated PNG for timestep {timestep} from file {file}", flush=True)
+        index = get_location_index()
+        writer = PartitionWriter(file, partition_dir, range_index)
+        rows = 0
+        for timestep, df in process_file(file, memory_budget, (start, end), selection):
+            report_timestep(timestep)
+
+            # Keep only agents at the selected locations, before the location join; otherwise the
+            # current location is not needed, as agents are drawn at their GPS positions. Timed as reading,
+            # like the time window and bounding box filters applied while the file is streamed
+            if selection is not None and selection.location_names:
+                with stage('read'):
+                    current_location_clean, _ = clean_locations(df['current_location'])
+                    selected = current_location_clean.isin(selection.location_names).to_numpy()
+                if not selected.any():
+                    continue
+                df = df[selected]
+            df['original_id'] = index.lookup(df['original_location'])
+            df = df.drop(columns=['original_location', 'current_location'])
+            writer.write(timestep, df)
+            rows += len(df)
+        return rows
     except Exception as e:
-        print(f"Error in processing file {file}: {traceback.format_exc()}")
+        print(f"Error in processing range {range_index} of file {file}: {traceback.format_exc()}")
+        return None
 
-def create_video_from_pngs(output_dir, video_filename="agents_movements_animation.mp4"):
+def pending_ranges(file_list, partition_dir, params, num_units):
     """
-    Create a video from PNG files in the output directory.
+    Function to split the files without valid cached partitions into newline-aligned byte ranges.
+    Returns the (file, start, end, range_index) work units, largest first.
     """
-    try:
-        # Specify the pattern for matching PNG files
-        file_pattern = os.path.join(output_dir, 'agents_timestep_*.png')
-        matching_files = sorted(glob.glob(file_pattern), key=lambda x: int(x.split('_')[-1].split('.')[0]))
-        
-        if not matching_files:
-            print("No PNG files found for video creation.")
-            return
+    pending_files = []
+    for file in file_list:
+        if not is_cached(file, partition_dir, params):
+            drop_source(file, partition_dir)
+            pending_files.append(file)
+    if len(pending_files) < len(file_list):
+        print(f"Using cached partitions of {len(file_list) - len(pending_files)} of {len(file_list)} files", flush=True)
+    units = plan_byte_ranges(pending_files, num_units)
+    return sorted(units, key=lambda unit: unit[2] - unit[1], reverse=True)
 
-        # Create a video clip from the PNGs
-        clip = ImageSequenceClip(matching_files, fps=2)  # Adjust fps as needed
-        video_path = os.path.join(output_dir, video_filename)
-        clip.write_videofile(video_path, codec="libx264")
-        print(f"Video created: {video_path}", flush=True)
+def render_partition(timestep, partition_dir, png_dir=None, store=None, scale=None):
+    try:
+        df = load_timestep(partition_dir, timestep)
+        if df is None:
+            return timestep, None, None
+        frame, digest = render_cached(timestep, [df], lambda: render_timestep(timestep, df, scale), store)
+        if png_dir is not None:
+            MapRenderer.save(frame, os.path.join(png_dir, f"agents_timestep_{timestep:03d}.png"))
+        return timestep, frame, digest
     except Exception as e:
-        print(f"Error during video creation: {traceback.format_exc()}")
+        print(f"Error in rendering timestep {timestep}: {traceback.format_exc()}")
+        return timestep, None, None
 
-def process_files(output_dir):
+def process_files(
+    output_dir, memory_budget=DEFAULT_MEMORY_BUDGET, save_pngs=False, fps=2, max_pending=None, incremental=False,
+    progress=False, summary_path=None, selection=None, auto_scale=True, profiles=None,
+    segmented=False, segment_frames=None, stages=None
+):
+    """
+    Process files and generate the video for agents, optionally with PNGs.
+    All output profiles are encoded from the same rendered frames; by default, one video at the rendered size.
+    With `segmented`, every worker renders and encodes whole segments of the timeline, which are joined afterwards.
+    With `stages`, files are partitioned, rendered and encoded in a pipeline (see pipeline.py).
+    """
+    start_time = time.perf_counter()
     try:
+        if segmented and stages is not None:
+            raise ValueError("Segmented encoding needs the whole timeline and cannot be pipelined")
+
         # Use the simulation directory as the working directory
         os.chdir(output_dir)
         
@@ -140,7 +169,8 @@ def process_files(output_dir):
             print(f"Error: Required locations.csv not found in '{os.path.join(output_dir, 'input_csv')}'.")
             return
         
-        locations_df = pd.read_csv(locations_file)
+        # Build the location index once; it is shared with every worker when the pools start
+        location_index = LocationIndex.from_csv(locations_file)
         
         file_list = sorted(glob.glob('agents.out.*'), key=lambda x: int(x.split('.')[-1]))
         if not file_list:
@@ -151,25 +181,119 @@ def process_files(output_dir):
             )
             return  # Exit the function if no files are found
         
-        num_workers = min(cpu_count(), len(file_list))
-        print(f"Found {len(file_list)} files and {num_workers} workers to process.")
-            
-        with Pool(processes=num_workers) as pool:
+        # Phase 1: repartition the rows of every file by timestep, reusing cached partitions;
+        # files are split into byte ranges, so that all CPUs parse in parallel even with few files
+        partition_dir = os.path.join(output_dir, "flee_partitions", "agents")
+        prune_sources(file_list, partition_dir)
+        selection = selection or Selection()
+        params = {'locations': file_key(locations_file), **selection.params()}
+        units = pending_ranges(file_list, partition_dir, params, 4 * cpu_count())
+
+        # One pool serves both phases; each worker holds a streaming reader and a warm renderer
+        num_workers = worker_count(BASE_WORKER_MEMORY + RENDERER_MEMORY + memory_budget)
+        print(f"Found {len(file_list)} files, {len(units)} byte ranges to parse and {num_workers} workers to process.")
+
+        # Workers started from now on report their per-stage timings when they exit
+        stats_dir = start_workers()
+
+        video_path = os.path.join(output_dir, "agents_movements_animation.mp4")
+        # Frames are rendered large enough for the largest output profile and downscaled for the others
+        profiles = profiles or [OutputProfile(fps=fps)]
+        dpi = dpi_for_sizes([profile.size for profile in profiles])
+        # The map extent follows the bounding box of the selection
+        renderers = {'agents': {'legend': LEGEND, 'extent': selection.extent(), 'dpi': dpi}}
+
+        # Pipelined runs render on this pool while a separate pool of readers partitions the files
+        if stages is not None:
+            stages = stages.resolve(num_workers)
+            num_workers = stages.render_workers
+        feed = None
+        with Pool(processes=num_workers, initializer=init_worker, initargs=(location_index, renderers)) as pool:
             try:
-                pool.starmap(
-                    process_and_plot, 
-                    [(file, locations_df, output_dir) for file in file_list]
+                tasks = [
+                    (file, start, end, range_index, partition_dir, memory_budget, selection)
+                    for file, start, end, range_index in units
+                ]
+
+                def finish_partitioning(results):
+                    # Files are cached only once all of their byte ranges are partitioned
+                    mark_complete(units, results, partition_dir, params)
+
+                if stages is not None:
+                    # Phases 1 and 2 overlap: each timestep is rendered as soon as every byte range has moved past it
+                    print(f"Pipelining {stages.read_workers} readers, {num_workers} renderers and the encoder.", flush=True)
+                    feed = TimestepFeed(
+                        stages.read_workers, location_index, partition_range, tasks, [unit[:2] for unit in units],
+                        [partition_dir], Progress(len(units), "Partitioning", progress), finish_partitioning
+                    )
+                    timesteps = feed
+                else:
+                    results = [None] * len(units)
+                    try:
+                        results = starmap_progress(pool, partition_range, tasks, Progress(len(units), "Partitioning", progress))
+                    except Exception as e:
+                        print(f"Error occurred during multiprocessing: {e}", flush=True)
+                    finish_partitioning(results)
+
+                    # Phase 2: render each timestep once from the merged partitions, on the same warm workers
+                    timesteps = list_timesteps(partition_dir)
+                    print(f"Found {len(timesteps)} timesteps and {num_workers} workers to render.")
+
+                # Marker sizes follow the populations of the whole run, so that all frames share one scale;
+                # pipelined runs render before the run is known and keep the fixed scale
+                scale = compute_scale('agents', partition_dir, timesteps, pool) if auto_scale and feed is None else None
+                if scale is not None:
+                    print(f"Largest markers for {scale:.0f} or more agents per cell", flush=True)
+
+                # Frames of earlier runs are reused unless their input rows or the render parameters changed
+                render_params = dict(RENDER_PARAMS, extent=selection.extent(), dpi=dpi, scale=scale)
+                store = FrameStore(os.path.join(output_dir, "flee_frames", "agents"), "agents", render_params) if incremental else None
+                render = partial(
+                    render_partition,
+                    partition_dir=partition_dir,
+                    png_dir=output_dir if save_pngs else None,
+                    store=store,
+                    scale=scale
                 )
-            except Exception as e:
-                print(f"Error occurred during multiprocessing: {e}", flush=True)
+                reused = []
+                render_progress = Progress(len(timesteps) if feed is None else None, "Rendering", progress)
+
+                def record_frame(result):
+                    render_progress.update()
+                    if store is not None and result is not None and result[2] is not None:
+                        reused.append(store.record(result[0], result[2]))
+
+                try:
+                    if segmented:
+                        # Workers encode consecutive segments of the timeline in parallel with their own encoders,
+                        # and the segments are joined without re-encoding
+                        video_paths = render_segmented(
+                            pool, render, timesteps, profiles, video_path,
+                            segment_frames or segment_length(len(timesteps), num_workers), record_frame
+                        )
+                    else:
+                        # Frames finish in any order and are reassembled by timestep before they reach the encoder;
+                        # at most max_pending frames are rendered ahead of the next one to write
+                        writer, video_paths = open_profiles(profiles, video_path, stages.encode_threads if stages else None)
+                        with writer:
+                            render_ordered(pool, render, timesteps, writer, max_pending or 2 * num_workers, record_frame)
+                    for path in video_paths:
+                        print(f"Video created: {path}", flush=True)
+                    if store is not None:
+                        store.save()
+                        print(f"Reused {sum(reused)} of {len(reused)} frames, rendered {len(reused) - sum(reused)}", flush=True)
+                except Exception as e:
+                    print(f"Error occurred during multiprocessing: {e}", flush=True)
             finally:
                 pool.close()
                 pool.join()
+                if feed is not None:
+                    feed.close()
 
-        print("All agents files processed and PNGs generated successfully.")
+        # Summarize the per-stage timings of this process and all workers
+        report_workers(stats_dir, summary_path or os.path.join(output_dir, "agents_run_summary.json"), start_time)
 
-        # Create video from the generated PNGs
-        create_video_from_pngs(output_dir)
+        print("All agents files processed and video created successfully.")
 
     except Exception as e:
         print(f"Error occurred: {traceback.format_exc()}")
@@ -186,6 +310,73 @@ if __name__ == "__main__":
         type=str,
         help="Path to the simulation output directory (e.g., nigeria2024_archer2_128)."
     )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=DEFAULT_MEMORY_BUDGET // 1024 ** 2,
+        help="Memory budget of the streaming reader of each worker, in MB."
+    )
+    parser.add_argument(
+        "--save-pngs",
+        action="store_true",
+        help="Also write every frame to a PNG file in the output directory."
+    )
+    parser.add_argument(
+        "--fps",
+        type=int,
+        default=2,
+        help="Frame rate of the video."
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        action="append",
+        default=None,
+        metavar="NAME:WIDTHxHEIGHT[:fps=N][:codec=CODEC][:crf=N]",
+        help="Write a video of this size and quality, named after the profile, e.g. archive:3840x2160:crf=18 or "
+             "preview:640x360:crf=30. May be repeated; every profile is encoded from the same rendered frames. "
+             "Default: one video at the rendered size."
+    )
+    parser.add_argument(
+        "--segmented",
+        action="store_true",
+        help="Encode segments of the video in parallel on the workers and join them without re-encoding."
+    )
+    parser.add_argument(
+        "--segment-frames",
+        type=int,
+        default=None,
+        help="Number of frames per segment with --segmented (default: several whole GOPs per worker)."
+    )
+    parser.add_argument(
+        "--max-pending",
+        type=int,
+        default=None,
+        help="Maximum number of frames rendered ahead of the video writer (default: twice the number of workers)."
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Keep the rendered frames in flee_frames/ and only re-render timesteps whose inputs changed in later runs."
+    )
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        help="Show a progress meter of each phase."
+    )
+    parser.add_argument(
+        "--summary",
+        type=str,
+        default=None,
+        help="Path of the JSON summary of the per-stage timings (default: agents_run_summary.json in the output directory)."
+    )
+    parser.add_argument(
+        "--fixed-scale",
+        action="store_true",
+        help="Clip marker sizes to 50-500 agents instead of scaling them by the populations of the run."
+    )
+    add_selection_arguments(parser)
+    add_pipeline_arguments(parser)
     args = parser.parse_args()
 
     output_dir = args.output_dir
@@ -197,7 +388,12 @@ if __name__ == "__main__":
 
     try:
         print(f"Processing files in directory: {output_dir}")
-        process_files(output_dir)
+        process_files(
+            output_dir, args.memory_budget * 1024 ** 2, args.save_pngs, args.fps, args.max_pending, args.incremental,
+            args.progress, args.summary, Selection.from_args(args), not args.fixed_scale,
+            [OutputProfile.parse(spec, args.fps) for spec in args.profile] if args.profile else None,
+            args.segmented, args.segment_frames, Stages.from_args(args)
+        )
         print("Processing completed successfully.")
     except Exception as e:
         print(f"Error in main function: {traceback.format_exc()}")
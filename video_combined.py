@@ -0,0 +1,359 @@
+import glob
+import os
+import argparse
+import time
+import traceback
+from multiprocessing import Pool, cpu_count
+from functools import partial
+
+from renderer import MapRenderer, get_renderer, dpi_for_sizes
+from encoder import OutputProfile, open_profiles
+from reorder import render_ordered
+from segments import render_segmented, segment_length
+from pipeline import Stages, TimestepFeed, add_pipeline_arguments
+from frames import FrameStore, render_cached
+from locations import LocationIndex
+from readers import DEFAULT_MEMORY_BUDGET
+from partition import file_key, mark_complete, prune_sources, list_timesteps, load_timestep
+from instrumentation import Progress, start_workers, report_workers, starmap_progress
+from selection import Selection, add_selection_arguments
+from scales import compute_scale
+from workers import init_worker, worker_count, BASE_WORKER_MEMORY, RENDERER_MEMORY
+
+import video_agents
+import video_links
+
+
+def render_timestep(timestep, agents_data, links_data, scales=None):
+    """
+    Render the agents and links layers of a timestep onto the same map and return the frame as an RGBA array.
+    `scales` holds the 'agents' and 'links' scales of the run (see scales.py); layers without one use fixed scales.
+    """
+    scales = scales or {}
+    try:
+        # One renderer with the agents legend serves both layers
+        renderer = get_renderer('combined', legend=video_agents.LEGEND)
+
+        # Links are drawn first so that the agent markers stay on top
+        if links_data is not None:
+            video_links.draw_links(renderer, links_data[links_data['#time'] == timestep], scales.get('links'))
+        if agents_data is not None:
+            video_agents.draw_agents(renderer, agents_data[agents_data['#time'] == timestep], scales.get('agents'))
+
+        return renderer.render()
+    except Exception as e:
+        print(f"Error in render_timestep for timestep {timestep}: {traceback.format_exc()}", flush=True)
+        raise
+
+
+def render_partition(timestep, agents_dir, links_dir, png_dir=None, store=None, scales=None):
+    """
+    Render the combined frame of a timestep from the partitions of both outputs, optionally saving it as PNG.
+    With a frame store, the stored frame is reused if neither the agents nor the links rows of the timestep changed.
+    """
+    try:
+        agents_data = load_timestep(agents_dir, timestep)
+        links_data = load_timestep(links_dir, timestep)
+        if agents_data is None and links_data is None:
+            return timestep, None, None
+        frame, digest = render_cached(
+            timestep,
+            [agents_data, links_data],
+            lambda: render_timestep(timestep, agents_data, links_data, scales),
+            store
+        )
+        if png_dir is not None:
+            MapRenderer.save(frame, os.path.join(png_dir, f"combined_timestep_{timestep:03d}.png"))
+        return timestep, frame, digest
+    except Exception as e:
+        print(f"Error rendering timestep {timestep}: {traceback.format_exc()}", flush=True)
+        return timestep, None, None
+
+
+def partition_task(kind, args):
+    """
+    Dispatch one partitioning unit to the agents reader (a byte range of a rank file) or the links reader (a rank file).
+    """
+    if kind == 'agents':
+        return video_agents.partition_range(*args)
+    return video_links.partition_file(*args)
+
+
+def process_files(
+    output_dir, memory_budget=DEFAULT_MEMORY_BUDGET, save_pngs=False, fps=2, max_pending=None, incremental=False,
+    progress=False, summary_path=None, selection=None, auto_scale=True, profiles=None,
+    segmented=False, segment_frames=None, stages=None
+):
+    """
+    Process agents and links files and generate a single video with both layers, optionally with PNGs.
+    All output profiles are encoded from the same rendered frames; by default, one video at the rendered size.
+    With `segmented`, every worker renders and encodes whole segments of the timeline, which are joined afterwards.
+    With `stages`, files are partitioned, rendered and encoded in a pipeline (see pipeline.py).
+    """
+    start_time = time.perf_counter()
+    try:
+        if segmented and stages is not None:
+            raise ValueError("Segmented encoding needs the whole timeline and cannot be pipelined")
+
+        # Use the simulation directory as the working directory
+        os.chdir(output_dir)
+
+        # Load the locations file
+        locations_file = os.path.join(output_dir, "input_csv", "locations.csv")
+        if not os.path.exists(locations_file):
+            print(f"Error: Required locations.csv not found in '{os.path.join(output_dir, 'input_csv')}'.")
+            return
+
+        # Build the location index once; it is shared with every worker when the pools start
+        location_index = LocationIndex.from_csv(locations_file)
+
+        agents_files = sorted(glob.glob('agents.out.*'), key=lambda x: int(x.split('.')[-1]))
+        links_files = sorted(glob.glob('links.out.*'), key=lambda x: int(x.split('.')[-1]))
+        if not agents_files and not links_files:
+            print(
+                f"No agents.out.* or links.out.* files found in directory '{output_dir}'.\n"
+                f"This code is designed to generate a combined video from agents.out.* and links.out.* files.\n"
+                f"Please ensure the files are generated in the simulation output directory before running this script."
+            )
+            return  # Exit the function if no files are found
+
+        # Phase 1: repartition the rows of every file by timestep, reusing the caches of video_agents.py/video_links.py
+        agents_dir = os.path.join(output_dir, "flee_partitions", "agents")
+        links_dir = os.path.join(output_dir, "flee_partitions", "links")
+        prune_sources(agents_files, agents_dir)
+        prune_sources(links_files, links_dir)
+        selection = selection or Selection()
+        agents_params = {'locations': file_key(locations_file), **selection.params()}
+        links_params = {'locations': file_key(locations_file), **selection.params()}
+
+        # Agents files are split into byte ranges, so that all CPUs parse in parallel even with few files
+        units = video_agents.pending_ranges(agents_files, agents_dir, agents_params, 4 * cpu_count())
+        tasks = [
+            ('agents', (file, start, end, range_index, agents_dir, memory_budget, selection))
+            for file, start, end, range_index in units
+        ]
+        tasks += [('links', (file, links_dir, links_params, selection)) for file in links_files]
+
+        # One pool serves both phases; each worker holds a streaming reader or a whole links file,
+        # and a warm renderer
+        largest_links_file = max((os.path.getsize(file) for file in links_files), default=0)
+        num_workers = worker_count(BASE_WORKER_MEMORY + RENDERER_MEMORY + max(memory_budget, 2 * largest_links_file))
+        print(f"Found {len(agents_files)} agents files, {len(links_files)} links files and {num_workers} workers to process.")
+
+        # Workers started from now on report their per-stage timings when they exit
+        stats_dir = start_workers()
+
+        video_path = os.path.join(output_dir, "combined_video.mp4")
+        # Frames are rendered large enough for the largest output profile and downscaled for the others
+        profiles = profiles or [OutputProfile(fps=fps)]
+        dpi = dpi_for_sizes([profile.size for profile in profiles])
+        # The map extent follows the bounding box of the selection
+        renderers = {'combined': {'legend': video_agents.LEGEND, 'extent': selection.extent(), 'dpi': dpi}}
+
+        # Pipelined runs render on this pool while a separate pool of readers partitions the files
+        if stages is not None:
+            stages = stages.resolve(num_workers)
+            num_workers = stages.render_workers
+        feed = None
+        with Pool(processes=num_workers, initializer=init_worker, initargs=(location_index, renderers)) as pool:
+            try:
+                def finish_partitioning(results):
+                    # Agents files are cached only once all of their byte ranges are partitioned
+                    mark_complete(units, results[:len(units)], agents_dir, agents_params)
+
+                if stages is not None:
+                    # Phases 1 and 2 overlap: each timestep is rendered as soon as every agents byte range
+                    # and every links file has moved past it
+                    print(f"Pipelining {stages.read_workers} readers, {num_workers} renderers and the encoder.", flush=True)
+                    feed = TimestepFeed(
+                        stages.read_workers, location_index, partition_task, tasks,
+                        [unit[:2] for unit in units] + [(file, 0) for file in links_files],
+                        [agents_dir, links_dir], Progress(len(tasks), "Partitioning", progress), finish_partitioning
+                    )
+                    timesteps = feed
+                else:
+                    results = [None] * len(tasks)
+                    try:
+                        results = starmap_progress(pool, partition_task, tasks, Progress(len(tasks), "Partitioning", progress))
+                    except Exception as e:
+                        print(f"Error occurred during multiprocessing: {e}", flush=True)
+                    finish_partitioning(results)
+
+                    # Phase 2: render both layers of each timestep in a single pass, on the same warm workers
+                    timesteps = sorted(set(list_timesteps(agents_dir)) | set(list_timesteps(links_dir)))
+                    print(f"Found {len(timesteps)} timesteps and {num_workers} workers to render.")
+
+                # Marker sizes and link colors follow the whole run, so that all frames share one scale per layer;
+                # pipelined runs render before the run is known and keep the fixed scales
+                scales = {}
+                if auto_scale and feed is None:
+                    scales = {
+                        'agents': compute_scale('agents', agents_dir, list_timesteps(agents_dir), pool),
+                        'links': compute_scale('links', links_dir, list_timesteps(links_dir), pool)
+                    }
+                    messages = []
+                    if scales['agents'] is not None:
+                        messages.append(f"Largest markers for {scales['agents']:.0f} or more agents per cell")
+                    if scales['links'] is not None:
+                        messages.append(f"top of the link color scale at {scales['links']:.0f} agents")
+                    if messages:
+                        message = ", ".join(messages)
+                        print(message[0].upper() + message[1:], flush=True)
+
+                # Frames of earlier runs are reused unless their input rows or the render parameters changed
+                store = None
+                if incremental:
+                    params = {
+                        'agents': dict(video_agents.RENDER_PARAMS, extent=selection.extent(), dpi=dpi, scale=scales.get('agents')),
+                        'links': dict(video_links.RENDER_PARAMS, extent=selection.extent(), dpi=dpi, vmax=scales.get('links'))
+                    }
+                    store = FrameStore(os.path.join(output_dir, "flee_frames", "combined"), "combined", params)
+                render = partial(
+                    render_partition,
+                    agents_dir=agents_dir,
+                    links_dir=links_dir,
+                    png_dir=output_dir if save_pngs else None,
+                    store=store,
+                    scales=scales
+                )
+                reused = []
+                render_progress = Progress(len(timesteps) if feed is None else None, "Rendering", progress)
+
+                def record_frame(result):
+                    render_progress.update()
+                    if store is not None and result is not None and result[2] is not None:
+                        reused.append(store.record(result[0], result[2]))
+
+                try:
+                    if segmented:
+                        # Workers encode consecutive segments of the timeline in parallel with their own encoders,
+                        # and the segments are joined without re-encoding
+                        video_paths = render_segmented(
+                            pool, render, timesteps, profiles, video_path,
+                            segment_frames or segment_length(len(timesteps), num_workers), record_frame
+                        )
+                    else:
+                        # Frames are reassembled by timestep and piped straight to the encoder
+                        writer, video_paths = open_profiles(profiles, video_path, stages.encode_threads if stages else None)
+                        with writer:
+                            render_ordered(pool, render, timesteps, writer, max_pending or 2 * num_workers, record_frame)
+                    for path in video_paths:
+                        print(f"Video created: {path}", flush=True)
+                    if store is not None:
+                        store.save()
+                        print(f"Reused {sum(reused)} of {len(reused)} frames, rendered {len(reused) - sum(reused)}", flush=True)
+                except Exception as e:
+                    print(f"Error occurred during multiprocessing: {e}", flush=True)
+            finally:
+                pool.close()
+                pool.join()
+                if feed is not None:
+                    feed.close()
+
+        # Summarize the per-stage timings of this process and all workers
+        report_workers(stats_dir, summary_path or os.path.join(output_dir, "combined_run_summary.json"), start_time)
+
+        print("All agents and links files processed and combined video created successfully.")
+
+    except Exception as e:
+        print(f"Error occurred: {traceback.format_exc()}")
+
+
+if __name__ == "__main__":
+    """
+    Main function to test the process_files function.
+    Accepts a command-line argument for the output directory.
+    """
+    parser = argparse.ArgumentParser(description="Process Flee simulation output to generate a combined agents and links video.")
+    parser.add_argument(
+        "output_dir",
+        type=str,
+        help="Path to the simulation output directory (e.g., nigeria2024_archer2_128)."
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=DEFAULT_MEMORY_BUDGET // 1024 ** 2,
+        help="Memory budget of the streaming reader of each worker, in MB."
+    )
+    parser.add_argument(
+        "--save-pngs",
+        action="store_true",
+        help="Also write every frame to a PNG file in the output directory."
+    )
+    parser.add_argument(
+        "--fps",
+        type=int,
+        default=2,
+        help="Frame rate of the video."
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        action="append",
+        default=None,
+        metavar="NAME:WIDTHxHEIGHT[:fps=N][:codec=CODEC][:crf=N]",
+        help="Write a video of this size and quality, named after the profile, e.g. archive:3840x2160:crf=18 or "
+             "preview:640x360:crf=30. May be repeated; every profile is encoded from the same rendered frames. "
+             "Default: one video at the rendered size."
+    )
+    parser.add_argument(
+        "--segmented",
+        action="store_true",
+        help="Encode segments of the video in parallel on the workers and join them without re-encoding."
+    )
+    parser.add_argument(
+        "--segment-frames",
+        type=int,
+        default=None,
+        help="Number of frames per segment with --segmented (default: several whole GOPs per worker)."
+    )
+    parser.add_argument(
+        "--max-pending",
+        type=int,
+        default=None,
+        help="Maximum number of frames rendered ahead of the video writer (default: twice the number of workers)."
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Keep the rendered frames in flee_frames/ and only re-render timesteps whose inputs changed in later runs."
+    )
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        help="Show a progress meter of each phase."
+    )
+    parser.add_argument(
+        "--summary",
+        type=str,
+        default=None,
+        help="Path of the JSON summary of the per-stage timings (default: combined_run_summary.json in the output directory)."
+    )
+    parser.add_argument(
+        "--fixed-scale",
+        action="store_true",
+        help="Use the fixed marker size and link color scales instead of scaling them by the run."
+    )
+    add_selection_arguments(parser)
+    add_pipeline_arguments(parser)
+    args = parser.parse_args()
+
+    output_dir = args.output_dir
+
+    # Ensure the output directory exists
+    if not os.path.exists(output_dir):
+        print(f"Error: The specified directory '{output_dir}' does not exist.")
+        exit(1)
+
+    try:
+        print(f"Processing files in directory: {output_dir}")
+        process_files(
+            output_dir, args.memory_budget * 1024 ** 2, args.save_pngs, args.fps, args.max_pending, args.incremental,
+            args.progress, args.summary, Selection.from_args(args), not args.fixed_scale,
+            [OutputProfile.parse(spec, args.fps) for spec in args.profile] if args.profile else None,
+            args.segmented, args.segment_frames, Stages.from_args(args)
+        )
+        print("Processing completed successfully.")
+    except Exception as e:
+        print(f"Error in main function: {traceback.format_exc()}")
@@ -1,21 +1,46 @@
+import numpy as np
 import pandas as pd
 import glob
 import os
 import argparse
+import time
 import traceback
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Pool
 import matplotlib.pyplot as plt
 from matplotlib import colors
-from mpl_toolkits.basemap import Basemap
-from moviepy.editor import ImageSequenceClip
+from functools import partial
 
+from renderer import MapRenderer, get_renderer, DEFAULT_EXTENT, dpi_for_sizes
+from encoder import OutputProfile, open_profiles
+from reorder import render_ordered
+from segments import render_segmented, segment_length
+from pipeline import Stages, TimestepFeed, report_timestep, add_pipeline_arguments
+from frames import FrameStore, render_cached
+from locations import LocationIndex, get_location_index
+from aggregate import sum_edges
+from partition import (
+    write_partitions, file_key, is_cached, mark_cached, drop_source, prune_sources, list_timesteps, load_timestep
+)
+from instrumentation import Progress, start_workers, report_workers, starmap_progress, stage, add
+from selection import Selection, add_selection_arguments
+from scales import compute_scale
+from workers import init_worker, worker_count, BASE_WORKER_MEMORY, RENDERER_MEMORY
 
-def process_file(file):
+# Parameters that change the look of a frame; stored frames are re-rendered when they change
+RENDER_PARAMS = {'extent': DEFAULT_EXTENT, 'cmap': 'coolwarm', 'norm': [0, 1000], 'alpha': 0.4, 'edges': 'summed'}
+
+
+def process_file(file, selection=None):
     """
     Process a single file and return a DataFrame.
+    With a selection, rows outside its time window and area are dropped before any other processing.
     """
     try:
-        df = pd.read_csv(file, index_col=False)
+        with stage('read', nbytes=os.path.getsize(file)):
+            df = pd.read_csv(file, index_col=False)
+            if selection:
+                df = selection.filter_links(df, get_location_index())
+        add('read', rows=len(df))
         df.index.name = 'Index'
         df = df.dropna()  # Drop rows with NaN values
         return df
@@ -27,110 +52,122 @@ def process_file(file):
         return None
 
 
-def plot_timestep(timestep, links_data, output_dir):
+def draw_links(renderer, timestep_data, vmax=1000):
+    """
+    Draw the links layer of one timestep onto a renderer, below any markers.
+    `vmax` is the number of agents on a link that gets the top color of the scale (see scales.py).
+    """
+    index = get_location_index()
+
+    # Create a colormap (e.g., blue to red)
+    cmap = plt.colormaps['coolwarm']
+    vmax = vmax or 1000
+    norm = colors.Normalize(vmin=0, vmax=vmax)
+
+    # Sum the partial counts of each link over all rank files, so every link is drawn once
+    start_ids, end_ids, link_counts = sum_edges(
+        timestep_data['start_id'].values, timestep_data['end_id'].values, timestep_data['cum_num_agents'].values, len(index)
+    )
+
+    # Colors and widths for all links at once
+    capped_values = np.minimum(link_counts, vmax)  # Cap values at the top of the scale
+    link_colors = cmap(norm(capped_values))
+    linewidths = np.minimum(0.5 + 5.0 * capped_values / vmax, 3.0)
+
+    # Projected start and end points of all links
+    start_x, start_y = index.project(renderer, start_ids)
+    end_x, end_y = index.project(renderer, end_ids)
+
+    # Plot connections between locations as a single collection
+    renderer.lines(
+        start_x,
+        start_y,
+        end_x,
+        end_y,
+        colors=link_colors,
+        alpha=0.4,
+        linewidths=linewidths,
+        zorder=0
+    )
+
+
+def render_timestep(timestep, links_data, vmax=None):
     """
-    Generate a PNG for a given timestep.
+    Render the frame of a given timestep and return it as an RGBA array.
     """
     try:
-        plt.figure(figsize=(12, 8))
-        m = Basemap(projection='merc', llcrnrlat=4, urcrnrlat=14, llcrnrlon=2, urcrnrlon=15, resolution='i')
-        m.drawcountries()
-        m.drawcoastlines()
+        # Reuse the projection and background of this process
+        renderer = get_renderer('links')
 
         # Filter data for this timestep
         timestep_data = links_data[links_data['#time'] == timestep]
+        draw_links(renderer, timestep_data, vmax)
 
-        # Create a colormap (e.g., blue to red)
-        cmap = plt.colormaps['coolwarm']
-        norm = colors.Normalize(vmin=0, vmax=1000)
-
-        # Plot connections between locations
-        for _, row in timestep_data.iterrows():
-            norm_value = norm(min(row['cum_num_agents'], 1000))  # Cap value at 1000
-            link_color = cmap(norm_value)
-            capped_value = min(row['cum_num_agents'], 1000)
-            linewidth = min(0.5 + 0.005 * capped_value, 3.0)
-
-            m.plot(
-                [row['start_lon'], row['end_lon']],
-                [row['start_lat'], row['end_lat']],
-                latlon=True,
-                color=link_color,
-                alpha=0.4,
-                linewidth=linewidth
-            )
-
-        output_path = os.path.join(output_dir, f"links_timestep_{timestep:03d}.png")
-        plt.savefig(output_path)
-        plt.close()
-        return output_path
+        return renderer.render()
     except Exception as e:
-        print(f"Error in plot_timestep for timestep {timestep}: {traceback.format_exc()}", flush=True)
+        print(f"Error in render_timestep for timestep {timestep}: {traceback.format_exc()}", flush=True)
         raise
 
 
-def process_and_plot(file, locations_df, output_dir):
+def partition_file(file, partition_dir, params, selection=None):
     """
-    Process a file and generate PNGs for all timesteps in it.
+    Process a file and split its rows into per-timestep partitions.
     """
     try:
-        df = process_file(file)
-        if df is not None:
-            # Merge coordinates for start and end locations
-            df = df.merge(
-                locations_df[['#name', 'latitude', 'longitude']].rename(
-                    columns={'#name': 'start_location', 'latitude': 'start_lat', 'longitude': 'start_lon'}
-                ),
-                on='start_location',
-                how='left'
-            )
-
-            df = df.merge(
-                locations_df[['#name', 'latitude', 'longitude']].rename(
-                    columns={'#name': 'end_location', 'latitude': 'end_lat', 'longitude': 'end_lon'}
-                ),
-                on='end_location',
-                how='left'
-            )
+        # Reuse the cached partitions if neither the file nor the processing parameters changed
+        if is_cached(file, partition_dir, params):
+            return
+        drop_source(file, partition_dir)
 
-            # Sort data by time
-            df = df.sort_values(by=['#time'])
+        df = process_file(file, selection)
+        if df is not None:
+            # Look up the location ids of the start and end locations
+            index = get_location_index()
+            df['start_id'] = index.lookup(df['start_location'])
+            df['end_id'] = index.lookup(df['end_location'])
+            df = df[['#time', 'start_id', 'end_id', 'cum_num_agents']]
 
-            # Generate PNGs for each timestep in this file
-            for timestep in sorted(df['#time'].unique()):
-                plot_timestep(timestep, df, output_dir)
-                print(f"Generated PNG for timestep {timestep} from file {file}", flush=True)
+            # Repartition the rows of this file by timestep
+            write_partitions(df, file, partition_dir, on_timestep=report_timestep)
+            mark_cached(file, partition_dir, params)
     except Exception as e:
         print(f"Error processing file {file}: {traceback.format_exc()}", flush=True)
 
 
-def create_video_from_pngs(output_dir, video_filename="links_movements_animation.mp4"):
+def render_partition(timestep, partition_dir, png_dir=None, store=None, vmax=None):
     """
-    Create a video from PNG files in the output directory.
+    Render the frame of a timestep from the rows of all files, optionally saving it as PNG.
+    With a frame store, the stored frame is reused if the rows of the timestep are unchanged.
     """
     try:
-        # Specify the pattern for matching PNG files
-        file_pattern = os.path.join(output_dir, 'links_timestep_*.png')
-        matching_files = sorted(glob.glob(file_pattern), key=lambda x: int(x.split('_')[-1].split('.')[0]))
-        
-        if not matching_files:
-            print("No PNG files found for video creation.")
-            return
-
-        # Create a video clip from the PNGs
-        clip = ImageSequenceClip(matching_files, fps=2)  # Adjust fps as needed
-        video_path = os.path.join(output_dir, video_filename)
-        clip.write_videofile(video_path, codec="libx264")
-        print(f"Video created: {video_path}", flush=True)
+        df = load_timestep(partition_dir, timestep)
+        if df is None:
+            return timestep, None, None
+        frame, digest = render_cached(timestep, [df], lambda: render_timestep(timestep, df, vmax), store)
+        if png_dir is not None:
+            MapRenderer.save(frame, os.path.join(png_dir, f"links_timestep_{timestep:03d}.png"))
+        return timestep, frame, digest
     except Exception as e:
-        print(f"Error during video creation: {traceback.format_exc()}")
+        print(f"Error rendering timestep {timestep}: {traceback.format_exc()}", flush=True)
+        return timestep, None, None
 
 
-def process_files(output_dir):
+def process_files(
+    output_dir, save_pngs=False, fps=2, max_pending=None, incremental=False, progress=False, summary_path=None,
+    selection=None, auto_scale=True, profiles=None,
+    segmented=False, segment_frames=None, stages=None
+):
     """
-    Process files and generate PNGs and video for links.
+    Process files and generate the video for links, optionally with PNGs.
+    All output profiles are encoded from the same rendered frames; by default, one video at the rendered size.
+    With `segmented`, every worker renders and encodes whole segments of the timeline, which are joined afterwards.
+    With `stages`, files are partitioned, rendered and encoded in a pipeline (see pipeline.py).
     """
+    start_time = time.perf_counter()
     try:
+        if segmented and stages is not None:
+            raise ValueError("Segmented encoding needs the whole timeline and cannot be pipelined")
+
         # Use the simulation directory as the working directory
         os.chdir(output_dir)
         
@@ -140,7 +177,8 @@ def process_files(output_dir):
             print(f"Error: Required locations.csv not found in '{os.path.join(output_dir, 'input_csv')}'.")
             return
         
-        locations_df = pd.read_csv(locations_file)
+        # Build the location index once; it is shared with every worker when the pools start
+        location_index = LocationIndex.from_csv(locations_file)
         
         file_list = sorted(glob.glob('links.out.*'), key=lambda x: int(x.split('.')[-1]))
         if not file_list:
@@ -151,25 +189,109 @@ def process_files(output_dir):
             )
             return  # Exit the function if no files are found
         
-        num_workers = min(cpu_count(), len(file_list))
+        # One pool serves both phases; each worker holds a whole links file (about twice its size
+        # once parsed) and a warm renderer
+        largest_file = max(os.path.getsize(file) for file in file_list)
+        num_workers = worker_count(BASE_WORKER_MEMORY + RENDERER_MEMORY + 2 * largest_file)
         print(f"Found {len(file_list)} files and {num_workers} workers to process.")
-            
-        with Pool(processes=num_workers) as pool:
+
+        # Phase 1: repartition the rows of every file by timestep, reusing cached partitions
+        partition_dir = os.path.join(output_dir, "flee_partitions", "links")
+        prune_sources(file_list, partition_dir)
+        selection = selection or Selection()
+        params = {'locations': file_key(locations_file), **selection.params()}
+
+        # Workers started from now on report their per-stage timings when they exit
+        stats_dir = start_workers()
+
+        video_path = os.path.join(output_dir, "links_movements_animation.mp4")
+        # Frames are rendered large enough for the largest output profile and downscaled for the others
+        profiles = profiles or [OutputProfile(fps=fps)]
+        dpi = dpi_for_sizes([profile.size for profile in profiles])
+        # The map extent follows the bounding box of the selection
+        renderers = {'links': {'extent': selection.extent(), 'dpi': dpi}}
+
+        # Pipelined runs render on this pool while a separate pool of readers partitions the files
+        if stages is not None:
+            stages = stages.resolve(num_workers)
+            num_workers = stages.render_workers
+        feed = None
+        with Pool(processes=num_workers, initializer=init_worker, initargs=(location_index, renderers)) as pool:
             try:
-                pool.starmap(
-                    process_and_plot, 
-                    [(file, locations_df, output_dir) for file in file_list]
+                tasks = [(file, partition_dir, params, selection) for file in file_list]
+                if stages is not None:
+                    # Phases 1 and 2 overlap: each timestep is rendered as soon as every file has moved past it
+                    print(f"Pipelining {stages.read_workers} readers, {num_workers} renderers and the encoder.", flush=True)
+                    feed = TimestepFeed(
+                        stages.read_workers, location_index, partition_file, tasks, [(file, 0) for file in file_list],
+                        [partition_dir], Progress(len(file_list), "Partitioning", progress)
+                    )
+                    timesteps = feed
+                else:
+                    try:
+                        starmap_progress(pool, partition_file, tasks, Progress(len(file_list), "Partitioning", progress))
+                    except Exception as e:
+                        print(f"Error occurred during multiprocessing: {e}", flush=True)
+
+                    # Phase 2: render each timestep once from the merged partitions, on the same warm workers
+                    timesteps = list_timesteps(partition_dir)
+                    print(f"Found {len(timesteps)} timesteps and {num_workers} workers to render.")
+
+                # Link colors follow the flows of the whole run, so that all frames share one scale;
+                # pipelined runs render before the run is known and keep the fixed scale
+                vmax = compute_scale('links', partition_dir, timesteps, pool) if auto_scale and feed is None else None
+                if vmax is not None:
+                    print(f"Top of the link color scale at {vmax:.0f} agents", flush=True)
+
+                # Frames of earlier runs are reused unless their input rows or the render parameters changed
+                render_params = dict(RENDER_PARAMS, extent=selection.extent(), dpi=dpi, vmax=vmax)
+                store = FrameStore(os.path.join(output_dir, "flee_frames", "links"), "links", render_params) if incremental else None
+                render = partial(
+                    render_partition,
+                    partition_dir=partition_dir,
+                    png_dir=output_dir if save_pngs else None,
+                    store=store,
+                    vmax=vmax
                 )
-            except Exception as e:
-                print(f"Error occurred during multiprocessing: {e}", flush=True)
+                reused = []
+                render_progress = Progress(len(timesteps) if feed is None else None, "Rendering", progress)
+
+                def record_frame(result):
+                    render_progress.update()
+                    if store is not None and result is not None and result[2] is not None:
+                        reused.append(store.record(result[0], result[2]))
+
+                try:
+                    if segmented:
+                        # Workers encode consecutive segments of the timeline in parallel with their own encoders,
+                        # and the segments are joined without re-encoding
+                        video_paths = render_segmented(
+                            pool, render, timesteps, profiles, video_path,
+                            segment_frames or segment_length(len(timesteps), num_workers), record_frame
+                        )
+                    else:
+                        # Frames finish in any order and are reassembled by timestep before they reach the encoder;
+                        # at most max_pending frames are rendered ahead of the next one to write
+                        writer, video_paths = open_profiles(profiles, video_path, stages.encode_threads if stages else None)
+                        with writer:
+                            render_ordered(pool, render, timesteps, writer, max_pending or 2 * num_workers, record_frame)
+                    for path in video_paths:
+                        print(f"Video created: {path}", flush=True)
+                    if store is not None:
+                        store.save()
+                        print(f"Reused {sum(reused)} of {len(reused)} frames, rendered {len(reused) - sum(reused)}", flush=True)
+                except Exception as e:
+                    print(f"Error occurred during multiprocessing: {e}", flush=True)
             finally:
                 pool.close()
                 pool.join()
+                if feed is not None:
+                    feed.close()
 
-        print("All link files processed and PNGs generated successfully.")
+        # Summarize the per-stage timings of this process and all workers
+        report_workers(stats_dir, summary_path or os.path.join(output_dir, "links_run_summary.json"), start_time)
 
-        # Create video from the generated PNGs
-        create_video_from_pngs(output_dir)
+        print("All link files processed and video created successfully.")
 
     except Exception as e:
         print(f"Error occurred: {traceback.format_exc()}")
@@ -186,6 +308,67 @@ if __name__ == "__main__":
         type=str,
         help="Path to the simulation output directory (e.g., nigeria2024_archer2_128)."
     )
+    parser.add_argument(
+        "--save-pngs",
+        action="store_true",
+        help="Also write every frame to a PNG file in the output directory."
+    )
+    parser.add_argument(
+        "--fps",
+        type=int,
+        default=2,
+        help="Frame rate of the video."
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        action="append",
+        default=None,
+        metavar="NAME:WIDTHxHEIGHT[:fps=N][:codec=CODEC][:crf=N]",
+        help="Write a video of this size and quality, named after the profile, e.g. archive:3840x2160:crf=18 or "
+             "preview:640x360:crf=30. May be repeated; every profile is encoded from the same rendered frames. "
+             "Default: one video at the rendered size."
+    )
+    parser.add_argument(
+        "--segmented",
+        action="store_true",
+        help="Encode segments of the video in parallel on the workers and join them without re-encoding."
+    )
+    parser.add_argument(
+        "--segment-frames",
+        type=int,
+        default=None,
+        help="Number of frames per segment with --segmented (default: several whole GOPs per worker)."
+    )
+    parser.add_argument(
+        "--max-pending",
+        type=int,
+        default=None,
+        help="Maximum number of frames rendered ahead of the video writer (default: twice the number of workers)."
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Keep the rendered frames in flee_frames/ and only re-render timesteps whose inputs changed in later runs."
+    )
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        help="Show a progress meter of each phase."
+    )
+    parser.add_argument(
+        "--summary",
+        type=str,
+        default=None,
+        help="Path of the JSON summary of the per-stage timings (default: links_run_summary.json in the output directory)."
+    )
+    parser.add_argument(
+        "--fixed-scale",
+        action="store_true",
+        help="Cap the link color scale at 1000 agents instead of scaling it by the flows of the run."
+    )
+    add_selection_arguments(parser)
+    add_pipeline_arguments(parser)
     args = parser.parse_args()
 
     output_dir = args.output_dir
@@ -197,7 +380,12 @@ if __name__ == "__main__":
 
     try:
         print(f"Processing files in directory: {output_dir}")
-        process_files(output_dir)
+        process_files(
+            output_dir, args.save_pngs, args.fps, args.max_pending, args.incremental, args.progress, args.summary,
+            Selection.from_args(args), not args.fixed_scale,
+            [OutputProfile.parse(spec, args.fps) for spec in args.profile] if args.profile else None,
+            args.segmented, args.segment_frames, Stages.from_args(args)
+        )
         print("Processing completed successfully.")
     except Exception as e:
         print(f"Error in main function: {traceback.format_exc()}")
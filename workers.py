@@ -0,0 +1,57 @@
+import os
+from multiprocessing import cpu_count
+
+import matplotlib
+
+from locations import set_location_index
+from renderer import get_renderer
+
+# Rough memory of an idle worker: the interpreter with pandas, matplotlib and the location index
+BASE_WORKER_MEMORY = 256 * 1024 ** 2
+
+# Rough memory of one warm renderer: the figure, the Basemap background and one RGBA frame
+RENDERER_MEMORY = 256 * 1024 ** 2
+
+
+def available_memory():
+    """
+    Function to return the memory available to new processes in bytes, or None if it cannot be determined.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def worker_count(memory_per_worker, max_workers=None):
+    """
+    Function to size a pool by the available CPUs and memory, so that nodes with many cores
+    but little memory per core do not run out of memory. Returns at least one worker.
+    """
+    num_workers = cpu_count()
+    if max_workers is not None:
+        num_workers = min(num_workers, max_workers)
+    memory = available_memory()
+    if memory is not None and memory_per_worker > 0:
+        num_workers = min(num_workers, memory // memory_per_worker)
+    return max(1, int(num_workers))
+
+
+def init_worker(location_index, renderers=None):
+    """
+    Function to set up a pool worker once, as the Pool initializer: share the location index,
+    select the Agg backend and build the renderers with their map backgrounds, so that every
+    task of the worker reuses the same figure instead of building a new projection.
+    `renderers` maps renderer names to the keyword arguments of `get_renderer`.
+    """
+    matplotlib.use('Agg')
+    set_location_index(location_index)
+    for name, kwargs in (renderers or {}).items():
+        get_renderer(name, **kwargs).prepare()